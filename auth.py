@@ -0,0 +1,79 @@
+# background authentication of scanned or recognized usernames against the server
+
+import time
+import logging
+import concurrent.futures
+import requests
+import metrics
+
+error_log = logging.getLogger('error')
+
+BARCODE_TO_AUTH_SECONDS = metrics.histogram('esd_barcode_to_auth_seconds', 'Time from a completed barcode scan to the authentication result')
+AUTH_SECONDS = metrics.histogram('esd_auth_request_seconds', 'Round-trip time of /esd/authenticate requests')
+
+class Authenticator():
+
+    def __init__(self, url, timeout, events, roster=None):
+        self.url = url
+        # employees found in the local roster are authenticated without a request
+        self.roster = roster
+        self.timeout = timeout
+        # ("auth", future) is put here when an answer arrives
+        self.events = events
+        self.session = requests.Session()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='auth')
+        self.future = None
+        # the username being authenticated, None once it was refused
+        self.username = None
+
+    def authenticate(self, username, input_time=None):
+        '''Start authenticating username in background, see check for the result'''
+        self.username = username
+        employee = self.roster.get(username) if self.roster is not None and self.roster.ready() else None
+        if employee is not None:
+            self.future = concurrent.futures.Future()
+            self.future.set_result(dict(employee))
+        else:
+            # unknown to the roster, maybe hired since the last sync, the server decides
+            self.future = self.executor.submit(self.request_user, username)
+        def done(future):
+            if input_time is not None:
+                BARCODE_TO_AUTH_SECONDS.observe(time.monotonic() - input_time)
+            # wake the ESD test up as soon as the answer arrives
+            self.events.put(("auth", future))
+        self.future.add_done_callback(done)
+
+    def request_user(self, username):
+        # runs on the auth thread, must not touch the UI
+        with AUTH_SECONDS.time():
+            res = self.session.post(self.url, { "username": username }, timeout=self.timeout)
+        if (res.status_code == 401):
+            return None
+        elif (res.status_code == 200):
+            return res.json()
+        return {}
+
+    def check(self):
+        '''Return (authorized, user): authorized is True, False or None while the request is pending, user the employee record if the server sent one'''
+        future = self.future
+        if future is None:
+            return self.username is not None, None
+        if not future.done():
+            return None, None
+
+        self.future = None
+        try:
+            json = future.result()
+        except Exception as e:
+            # let the user through if the server can't be reached
+            error_log.exception(e, exc_info=True)
+            return True, None
+
+        if json is None:
+            self.username = None
+            return False, None
+        return True, json if "username" in json else None
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.session.close()
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+
+# end-to-end latency benchmark: runs a station on the fake GPIO backend against the stub server
+#
+#   python3 benchmark.py --scans 20 --camera samples/walkup.mp4 --latency 0.1 --save baseline.json
+#   python3 benchmark.py --scans 20 --camera samples/walkup.mp4 --latency 0.1 --baseline baseline.json
+
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import subprocess
+import urllib.request
+
+DIR_NAME = os.path.dirname(os.path.abspath(__file__))
+
+# metrics where a higher value is better, every other one is a latency or a cost
+HIGHER_IS_BETTER = ("frames_per_second",)
+
+def percentile(values, p):
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100.0
+    f = int(k)
+    c = min(f + 1, len(values) - 1)
+    return values[f] + (values[c] - values[f]) * (k - f)
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+class Key():
+
+    def __init__(self, char):
+        self.char = char
+        self.keysym = 'Return' if char == '\r' else char
+
+class Benchmark():
+
+    def __init__(self, app, station, args):
+        self.app = app
+        self.station = station
+        self.args = args
+        self.page = app.frames["MainPage"]
+        self.io = station.IO
+        self.io.output_listeners.append(self.on_output)
+        # start of the transaction waiting for the gate
+        self.started = None
+        self.kind = None
+        self.latencies = { "scan": [], "face": [] }
+        self.timeouts = { "scan": 0, "face": 0 }
+        self.frames = 0
+        self.face_started = None
+        self.face_duration = 0
+
+        # count the frames put on screen
+        show_frame = self.page.show_frame
+        def counted_show_frame(frame):
+            self.frames += 1
+            show_frame(frame)
+        self.page.show_frame = counted_show_frame
+
+    def start(self):
+        self.wall = time.time()
+        self.cpu = cpu_time()
+        self.run_scans(self.args.scans)
+
+    def on_output(self, pin, level):
+        if pin == self.station.GATE_RELAY_PIN and level == 1 and self.started is not None:
+            self.latencies[self.kind].append(time.perf_counter() - self.started)
+            self.started = None
+
+    def begin(self, kind):
+        # a transaction still waiting for the gate never got through
+        if self.started is not None:
+            self.timeouts[self.kind] += 1
+        self.kind = kind
+        self.started = time.perf_counter()
+
+    def step_on(self):
+        # the light sensors read 0 when the foot passes
+        self.io.set_input(self.station.LIGHT_SENSOR_LEFT_PIN, 0)
+        self.io.set_input(self.station.LIGHT_SENSOR_RIGHT_PIN, 0)
+
+    def step_off(self):
+        self.io.set_input(self.station.LIGHT_SENSOR_LEFT_PIN, 1)
+        self.io.set_input(self.station.LIGHT_SENSOR_RIGHT_PIN, 1)
+
+    def run_scans(self, remaining):
+        self.step_off()
+        if remaining == 0:
+            self.app.after(100, self.run_faces, self.args.faces if self.args.camera else 0)
+            return
+
+        self.begin("scan")
+        for char in 'EMP{0:04d}\r'.format(remaining):
+            self.app.read_key(Key(char))
+        self.app.after(int(self.args.step_delay * 1000), self.step_on)
+        self.app.after(int(self.args.interval * 1000), self.run_scans, remaining - 1)
+
+    def run_faces(self, remaining):
+        self.step_off()
+        self.io.set_input(self.station.IR_SENSOR_PIN, 0)
+        if remaining == 0:
+            if self.face_started is not None:
+                self.face_duration = time.time() - self.face_started
+            self.app.after(100, self.finish)
+            return
+
+        if self.face_started is None:
+            self.face_started = time.time()
+            self.face_requests = self.server_stats()["requests"].get("/api/face", 0)
+        self.begin("face")
+        self.io.set_input(self.station.IR_SENSOR_PIN, 1)
+        self.app.after(int(self.args.step_delay * 1000), self.step_on)
+        self.app.after(int(self.args.interval * 1000), self.run_faces, remaining - 1)
+
+    def server_stats(self):
+        with urllib.request.urlopen(self.station.API_URL + '/stats') as res:
+            return json.loads(res.read())
+
+    def finish(self):
+        self.begin(None)
+        wall = time.time() - self.wall
+        stats = self.server_stats()
+        face_requests = stats["requests"].get("/api/face", 0) - getattr(self, "face_requests", 0)
+
+        self.report = {}
+        for kind in ("scan", "face"):
+            for p in (50, 90, 99):
+                value = percentile(self.latencies[kind], p)
+                self.report["{0}_to_gate_p{1}_ms".format(kind, p)] = None if value is None else round(value * 1000, 1)
+            self.report["{0}_timeouts".format(kind)] = self.timeouts[kind]
+        self.report["frames_per_second"] = round(self.frames / self.face_duration, 1) if self.face_duration > 0 else None
+        self.report["face_uploads_per_second"] = round(face_requests / self.face_duration, 2) if self.face_duration > 0 else None
+        self.report["face_upload_bytes"] = stats["bytes_received"].get("/api/face", 0)
+        self.report["cpu_percent"] = round((cpu_time() - self.cpu) / wall * 100, 1)
+        self.app.quit()
+
+def start_stub_server(args):
+    command = [sys.executable, os.path.join(DIR_NAME, 'stub_server.py'), '--port', '0',
+        '--latency', str(args.latency), '--jitter', str(args.jitter), '--error-rate', str(args.error_rate), '--face-after', str(args.face_after)]
+    server = subprocess.Popen(command, stdout=subprocess.PIPE, universal_newlines=True)
+    # the server prints its url once it listens
+    url = server.stdout.readline().strip().split(' ')[-1]
+    return server, url
+
+def compare(report, baseline, tolerance):
+    regressions = []
+    for name, expected in baseline.items():
+        value = report.get(name)
+        if value is None or expected is None or not isinstance(expected, (int, float)):
+            continue
+        if name in HIGHER_IS_BETTER:
+            if value < expected * (1 - tolerance):
+                regressions.append(name)
+        elif value > expected * (1 + tolerance) and value - expected > 1:
+            regressions.append(name)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Scan-to-gate and face-to-gate benchmark on simulated hardware')
+    parser.add_argument('--scans', type=int, default=10, help='barcode transactions to run')
+    parser.add_argument('--faces', type=int, default=5, help='face transactions to run, needs --camera')
+    parser.add_argument('--camera', help='video file or image directory played as the camera')
+    parser.add_argument('--interval', type=float, default=5, help='seconds between transactions')
+    parser.add_argument('--step-delay', type=float, default=0.2, help='seconds from scan or motion to stepping on the plates')
+    parser.add_argument('--latency', type=float, default=0.05, help='stub server latency, seconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='stub server random extra latency, seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of stub server requests failing')
+    parser.add_argument('--face-upload', default='base64', choices=('base64', 'jpeg', 'multipart'), help='face frame upload format')
+    parser.add_argument('--face-after', type=int, default=3, help='unknown-face answers before a match')
+    parser.add_argument('--save', help='write the report as JSON to this file')
+    parser.add_argument('--baseline', help='fail if the report regresses against this JSON report')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative regression')
+    args = parser.parse_args()
+
+    server, url = start_stub_server(args)
+    os.environ['ESD_GPIO'] = 'fake'
+    os.environ['ESD_API_URL'] = url
+    os.environ['ESD_CAMERA'] = args.camera or '0'
+    os.environ['ESD_FACE_UPLOAD'] = args.face_upload
+    sys.path.insert(0, DIR_NAME)
+    import main as station
+
+    # results of the benchmark must not end up in the station's real outbox
+    workdir = tempfile.mkdtemp(prefix='esd-bench-')
+    station.OUTBOX_FILE = os.path.join(workdir, 'outbox.db')
+    station.ROSTER_FILE = os.path.join(workdir, 'roster.db')
+    station.METRICS_PORT = None
+    # idle levels: nobody in front of the camera, nobody on the plates
+    station.IO.set_input(station.IR_SENSOR_PIN, 0)
+    station.IO.set_input(station.LIGHT_SENSOR_LEFT_PIN, 1)
+    station.IO.set_input(station.LIGHT_SENSOR_RIGHT_PIN, 1)
+
+    try:
+        app = station.App()
+        bench = Benchmark(app, station, args)
+        app.after(1000, bench.start)
+        app.mainloop()
+    finally:
+        server.terminate()
+
+    report = bench.report
+    for name, value in report.items():
+        print('{0:<28} {1}'.format(name, '-' if value is None else value))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if len(regressions) > 0:
+            print('regressed: ' + ', '.join(regressions))
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,211 @@
+# camera capture running on its own thread, frames are shared through a latest-frame-wins buffer
+
+import os
+import time
+import logging
+import threading
+import metrics
+from lazy import LazyModule
+
+cv2 = LazyModule('cv2')
+
+error_log = logging.getLogger('error')
+
+CAMERA_OPEN_SECONDS = metrics.histogram('esd_camera_open_seconds', 'Time to open the camera device')
+CAMERA_WAKE_SECONDS = metrics.histogram('esd_camera_wake_seconds', 'Time from waking the camera up to its first frame')
+
+class FrameBuffer():
+    '''Latest frame wins, frames are captured into a fixed set of reused arrays'''
+
+    def __init__(self, slots=4):
+        self.cond = threading.Condition()
+        self.frame = None
+        # sequence number of the latest frame, consumers use it to skip frames they have seen
+        self.seq = 0
+        # one array being captured into, the latest frame and one held by each consumer
+        self.slots = [None] * slots
+        self.holds = [0] * slots
+
+    def writable(self):
+        '''Return (slot, array or None) to capture the next frame into, an array nobody holds'''
+        with self.cond:
+            for slot, array in enumerate(self.slots):
+                if self.holds[slot] == 0 and (array is None or array is not self.frame):
+                    return slot, array
+            # every array is in use, more consumers than slots
+            return None, None
+
+    def put(self, frame, slot=None):
+        with self.cond:
+            if slot is not None:
+                # the capture allocates a new array only when the frame size changed
+                self.slots[slot] = frame
+            # older frames are simply dropped, nobody needs them anymore
+            self.frame = frame
+            self.seq += 1
+            self.cond.notify_all()
+
+    def latest(self, hold=False):
+        '''Return (seq, frame), a held frame is not overwritten until it is released'''
+        with self.cond:
+            if hold:
+                self.hold(self.frame)
+            return self.seq, self.frame
+
+    def wait(self, seq, timeout=None, hold=False):
+        '''Wait for a frame newer than seq, return (seq, frame) or (seq, None) on timeout'''
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.seq > seq and self.frame is not None, timeout):
+                return seq, None
+            if hold:
+                self.hold(self.frame)
+            return self.seq, self.frame
+
+    def hold(self, frame):
+        for slot, array in enumerate(self.slots):
+            if array is frame and frame is not None:
+                self.holds[slot] += 1
+
+    def release(self, frame):
+        with self.cond:
+            for slot, array in enumerate(self.slots):
+                if array is frame and frame is not None:
+                    self.holds[slot] -= 1
+
+    def clear(self):
+        with self.cond:
+            self.frame = None
+
+class FileCapture():
+    '''Video file or directory of images played back like a camera, looping at the end'''
+
+    IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+    def __init__(self, source, fps=None):
+        self.video = None
+        self.files = []
+        self.index = 0
+        if os.path.isdir(source):
+            self.files = sorted(os.path.join(source, name) for name in os.listdir(source) if name.lower().endswith(self.IMAGE_EXTENSIONS))
+        else:
+            self.video = cv2.VideoCapture(source)
+            if fps is None and self.video.isOpened():
+                fps = self.video.get(cv2.CAP_PROP_FPS)
+        self.interval = 1.0 / (fps or 15)
+        self.next_frame = time.monotonic()
+
+    def isOpened(self):
+        return len(self.files) > 0 or (self.video is not None and self.video.isOpened())
+
+    def wait(self):
+        # block until the frame is due, as a real device would
+        delay = self.next_frame - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        self.next_frame = max(self.next_frame + self.interval, time.monotonic())
+
+    def grab(self):
+        self.wait()
+        if self.video is not None:
+            return self.video.grab()
+        self.index += 1
+        return True
+
+    def read(self, image=None):
+        self.wait()
+        if self.video is not None:
+            ok, frame = self.video.read(image)
+            if not ok:
+                self.video.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                ok, frame = self.video.read(image)
+            return ok, frame
+
+        frame = cv2.imread(self.files[self.index % len(self.files)])
+        self.index += 1
+        return frame is not None, frame
+
+    def release(self):
+        if self.video is not None:
+            self.video.release()
+
+def open_capture(source):
+    '''Open a camera by device index, or a video file or image directory for simulation'''
+    if str(source).isdigit():
+        capture = cv2.VideoCapture(int(source))
+        # don't queue frames up in the driver, a woken camera must deliver a fresh one
+        capture.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        return capture
+    return FileCapture(source)
+
+class CameraStream(threading.Thread):
+
+    def __init__(self, source, buffer, standby_fps=2, active=True):
+        threading.Thread.__init__(self, name='camera', daemon=True)
+        self.source = source
+        self.buffer = buffer
+        self.capture = None
+        self.opened = threading.Event()
+        self.failed = False
+        self.stopped = threading.Event()
+        # in standby the device keeps streaming at standby_fps, but frames are neither decoded nor published
+        self.standby_interval = 1.0 / standby_fps
+        self.active = threading.Event()
+        self.woken = time.perf_counter()
+        if active:
+            self.active.set()
+
+    def run(self):
+        # opening the device can take a while, so it's done here rather than on the UI thread
+        try:
+            with CAMERA_OPEN_SECONDS.time():
+                self.capture = open_capture(self.source)
+            if not self.capture.isOpened():
+                raise IOError('cannot open camera {0}'.format(self.source))
+        except Exception as e:
+            error_log.exception(e, exc_info=True)
+            self.failed = True
+            return
+        finally:
+            self.opened.set()
+
+        waking = True
+        while not self.stopped.is_set():
+            if not self.active.is_set():
+                # grabbing without decoding keeps the device warm at next to no cost
+                self.capture.grab()
+                self.active.wait(self.standby_interval)
+                waking = True
+                continue
+
+            # read blocks until the next frame, so this loop runs at the camera rate
+            # the frame is decoded into an array of the buffer that nobody uses anymore
+            slot, array = self.buffer.writable()
+            ok, frame = self.capture.read(array)
+            if not ok:
+                time.sleep(0.05)
+                continue
+            if waking:
+                CAMERA_WAKE_SECONDS.observe(time.perf_counter() - self.woken)
+                waking = False
+            self.buffer.put(frame, slot)
+
+        self.capture.release()
+
+    def wake(self):
+        '''Deliver frames at the full camera rate'''
+        if not self.active.is_set():
+            self.woken = time.perf_counter()
+            self.active.set()
+
+    def standby(self):
+        '''Keep the device open at a low rate without delivering frames'''
+        self.active.clear()
+        self.buffer.clear()
+
+    def stop(self):
+        self.stopped.set()
+        self.active.set()
+        # the capture is released by the thread itself once the pending read returns
+        if self.is_alive():
+            self.join(1)
+        self.buffer.clear()
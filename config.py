@@ -0,0 +1,103 @@
+# station configuration, shared by the screen and the headless gate controller
+
+import os
+
+# module attached
+IR_SENSOR_PIN = 5
+LIGHT_SENSOR_LEFT_PIN = 14
+LIGHT_SENSOR_RIGHT_PIN = 15
+GATE_RELAY_PIN = 18
+# feedback of the headless gate controller, stations with a screen leave them unconnected
+BUZZER_PIN = 23
+LED_PASSED_PIN = 24
+LED_FAILED_PIN = 25
+
+# main config
+DIR_NAME = os.path.dirname(os.path.abspath(__file__))
+API_URL = os.environ.get('ESD_API_URL', 'http://172.16.65.18:8989/api')
+MACHINE = 'ESD-[Station]'
+REQUEST_TIMEOUT = 1 #seconds
+GATE_TIMEOUT = 7 #seconds
+RECOGNIZE_TIMEOUT = 3 #seconds
+CAMERA_TIMEOUT = 300 #seconds
+CAMERA_COOLDOWN = 1 #seconds before a closed camera may be opened again
+ESD_TEST_TIMEOUT = 7 #seconds
+ESD_MIN_DURATION = 1 #seconds both feet must pass before the gate opens
+RESULT_DISPLAY_TIME = 3 #seconds a result message stays before the screen is refreshed
+UNAUTHORIZED_DISPLAY_TIME = 1 #seconds
+IR_DEBOUNCE = 0.1 #seconds
+FOOT_DEBOUNCE = 0.05 #seconds
+TICK_INTERVAL = 20 #milliseconds, longest time between two scheduler ticks
+FEEDBACK_TIME = 0.2 #seconds the buzzer sounds for a beep
+SCANNER_DEVICES = [device for device in os.environ.get('ESD_SCANNERS', '').split(',') if len(device) > 0] #evdev paths or names, empty to read the keyboard
+SCANNER_MAX_GAP = 0.05 #seconds between the keys of a scan
+SCANNER_MIN_LENGTH = 4 #characters of the shortest code
+CAMERA_SOURCE = os.environ.get('ESD_CAMERA', '0') #device index, video file or image directory
+CAMERA_FPS = 15 #frames displayed per second
+CAMERA_STANDBY = True #keep the camera open between visitors instead of closing it
+CAMERA_STANDBY_FPS = 2 #frames grabbed per second in standby
+CAMERA_STANDBY_DELAY = 500 #milliseconds after startup before the camera is opened in standby
+SPRITE_CACHE_SIZE = 16
+FOOT_SIZE = (200, 100) #pixels
+FACE_DETECT_WIDTH = 320 #pixels
+FACE_CROP_SIZE = 200 #pixels
+FACE_MAX_INFLIGHT = 2 #requests
+# uploads adapt to the recognition server's load: the rate halves when answers are slow or fail and grows back
+# step by step, past the minimum rate the (JPEG quality, crop size) levels are stepped down
+FACE_MIN_RATE = 0.5 #frames per second
+FACE_MAX_RATE = 7.5 #frames per second
+FACE_RATE_STEP = 0.5 #frames per second added on every fast answer
+FACE_TARGET_LATENCY = 0.5 #seconds, slower answers count as congestion
+FACE_QUALITY_LEVELS = ((80, FACE_CROP_SIZE), (65, 160), (50, 128)) #(JPEG quality 0-100, pixels)
+FACE_MATCH_EVIDENCE = 1.0 #matches needed to identify an employee, fractions of one count for weaker matches
+FACE_UNKNOWN_EVIDENCE = 2.5 #unknown-face answers within FACE_UNKNOWN_WINDOW before falling back to the barcode
+FACE_UNKNOWN_WINDOW = 2.5 #seconds
+FACE_UNKNOWN_SHARE = 0.8 #share of the answers within the window that must be unknown faces
+FACE_EVIDENCE_HALF_LIFE = 1.5 #seconds for a match to count half
+FACE_CACHED_WEIGHT = 0.5 #evidence of an answer from the response cache, a fresh answer counts 1
+FACE_CACHE_TTL = 2 #seconds an answer is reused for near duplicate frames, 0 to disable
+FACE_CACHE_SIZE = 32 #answers
+FACE_CACHE_DISTANCE = 6 #bits the perceptual hashes of near duplicate frames may differ in
+FACE_MIN_TIMEOUT = 0.5 #seconds
+FACE_MAX_TIMEOUT = 3 #seconds
+FACE_UPLOAD_FORMAT = os.environ.get('ESD_FACE_UPLOAD', 'base64') #base64, jpeg or multipart, as supported by the server
+FACE_FRAMES_PER_REQUEST = 2 #frames packed into one multipart request
+LOCAL_FACE_CAPACITY = 50 #employees recognized on the station, 0 to always ask the server
+LOCAL_FACE_SAMPLES = 10 #face crops kept per employee
+LOCAL_FACE_THRESHOLD = 45.0 #LBPH distance of a confident local match
+OUTBOX_FILE = DIR_NAME + '/data/outbox.db'
+OUTBOX_RETENTION = 7 * 24 * 3600 #seconds
+UPLOAD_BATCH_SIZE = 20
+ROSTER_FILE = DIR_NAME + '/data/roster.db'
+ROSTER_SYNC_INTERVAL = 300 #seconds between roster delta syncs, None to always ask the server
+ROSTER_SYNC_TIMEOUT = 30 #seconds, the first sync downloads the whole roster
+ROSTER_MAX_AGE = 3 * ROSTER_SYNC_INTERVAL if ROSTER_SYNC_INTERVAL is not None else None #seconds since the last successful sync before the server decides again
+
+# metrics for the fleet dashboards, set the port or the file to None to disable
+METRICS_PORT = 9110
+METRICS_FILE = None
+METRICS_FILE_INTERVAL = 15 #seconds
+
+# SIGUSR1 samples every thread for this long into logs/profile-*.folded, SIGUSR2 toggles the trace spans
+PROFILE_SECONDS = 10
+
+# the memory watchdog exports esd_rss_bytes, and logs (MEMORY_ACTION "log") or exits with status 1
+# (MEMORY_ACTION "restart") when the process passes MEMORY_LIMIT_MB or grows MEMORY_GROWTH_MB past its size
+# after warm-up, MEMORY_TRACE_FRAMES > 0 adds the biggest allocation sites to the report
+# only use "restart" where a supervisor starts the station again, e.g. a systemd unit with Restart=on-failure
+MEMORY_CHECK_INTERVAL = 60 #seconds
+MEMORY_WARMUP = 600 #seconds
+MEMORY_LIMIT_MB = int(os.environ.get('ESD_MEMORY_LIMIT_MB', 600))
+MEMORY_GROWTH_MB = int(os.environ.get('ESD_MEMORY_GROWTH_MB', 200))
+MEMORY_ACTION = os.environ.get('ESD_MEMORY_ACTION', 'log')
+MEMORY_TRACE_FRAMES = int(os.environ.get('ESD_MEMORY_TRACE_FRAMES', 0))
+
+# log files are rotated by size or age and the rotated ones gzipped, keeping the SD card usage bounded
+LOG_MAX_BYTES = 1024 * 1024
+LOG_BACKUP_COUNT = 5
+LOG_ROTATE_INTERVAL = 24 * 3600 #seconds
+LOG_QUEUE_SIZE = 10000 #records waiting for the writer, more are dropped
+
+# hardware backends, "fake" runs the station without a Pi for simulation and benchmarks
+GPIO_BACKEND = os.environ.get('ESD_GPIO', 'rpi') #rpi or fake
+GPIO_SCRIPT = os.environ.get('ESD_GPIO_SCRIPT') #JSON sensor timeline for the fake backend
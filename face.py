@@ -0,0 +1,144 @@
+# on-device face processing in front of the recognition server
+
+import threading
+import collections
+from lazy import LazyModule
+from profiler import span
+
+cv2 = LazyModule('cv2')
+numpy = LazyModule('numpy')
+
+def perceptual_hash(image):
+    '''64 bit DCT hash of image, near duplicate images differ in a few bits only'''
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    small = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA)
+    # the lowest frequencies describe the structure of the image, not its noise
+    low = cv2.dct(numpy.float32(small))[:8, :8].flatten()
+    bits = low > numpy.median(low[1:])
+    return int(''.join('1' if bit else '0' for bit in bits), 2)
+
+class FaceDetector():
+
+    def __init__(self, cascade_file=None, detect_width=320, min_size=40, margin=0.3, crop_size=200):
+        if cascade_file is None:
+            cascade_file = cv2.data.haarcascades + 'haarcascade_frontalface_default.xml'
+        self.cascade = cv2.CascadeClassifier(cascade_file)
+        if self.cascade.empty():
+            raise IOError('cannot load face cascade ' + cascade_file)
+        # frames are downscaled to this width before detection
+        self.detect_width = detect_width
+        # smallest face in pixels of the downscaled frame
+        self.min_size = min_size
+        # extra border around the face box, relative to its size
+        self.margin = margin
+        # longest side of the uploaded crop
+        self.crop_size = crop_size
+
+    @span('face_detect')
+    def detect(self, frame):
+        '''Return the largest face in frame as (x, y, w, h) or None'''
+        scale = min(1.0, self.detect_width / frame.shape[1])
+        if scale < 1.0:
+            small = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        else:
+            small = frame
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        faces = self.cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(self.min_size, self.min_size))
+        if len(faces) == 0:
+            return None
+
+        x, y, w, h = max(faces, key=lambda f: f[2] * f[3])
+        return int(x / scale), int(y / scale), int(w / scale), int(h / scale)
+
+    def crop(self, frame, face, size=None):
+        '''Cut the face region with its margin out of frame, downscaled to size or crop_size'''
+        x, y, w, h = face
+        m = int(max(w, h) * self.margin)
+        height, width = frame.shape[:2]
+        crop = frame[max(0, y - m):min(height, y + h + m), max(0, x - m):min(width, x + w + m)]
+        scale = (size or self.crop_size) / max(crop.shape[:2])
+        if scale < 1.0:
+            crop = cv2.resize(crop, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        return crop
+
+class LocalRecognizer():
+    '''LBPH model of the employees the server recognized lately, the least recently seen ones are forgotten'''
+
+    def __init__(self, capacity=50, samples=10, threshold=45.0, size=(100, 100)):
+        # needs the contrib modules of OpenCV
+        if not hasattr(cv2, 'face'):
+            raise ImportError('cv2.face is not available, install opencv-contrib-python')
+        self.capacity = capacity
+        self.samples = samples
+        # LBPH distance, lower is closer, matches above it are ignored
+        self.threshold = threshold
+        self.size = size
+        self.lock = threading.Lock()
+        # username -> [label, fullname, deque of gray face images], in least recently seen order
+        self.people = collections.OrderedDict()
+        self.labels = {}
+        self.next_label = 0
+        self.model = None
+        # the model is rebuilt once people were forgotten, new samples are added incrementally
+        self.retrain = False
+        self.new_samples = []
+        # samples still in the model that have left their deque
+        self.stale = 0
+
+    def prepare(self, crop):
+        gray = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY) if crop.ndim == 3 else crop
+        return cv2.equalizeHist(cv2.resize(gray, self.size, interpolation=cv2.INTER_AREA))
+
+    def add(self, username, fullname, crops):
+        '''Learn face crops of an employee the server has recognized'''
+        images = [self.prepare(crop) for crop in crops]
+        with self.lock:
+            person = self.people.get(username)
+            if person is None:
+                person = self.people[username] = [self.next_label, fullname, collections.deque(maxlen=self.samples)]
+                self.labels[self.next_label] = username
+                self.next_label += 1
+            self.people.move_to_end(username)
+            person[1] = fullname
+            # samples falling out of the deque are only dropped from the model by rebuilding it, once there
+            # are as many of them as a person has samples, so the model (and predict) stays bounded
+            self.stale += max(0, len(person[2]) + len(images) - self.samples)
+            if self.stale >= self.samples:
+                self.retrain = True
+            person[2].extend(images)
+            if not self.retrain:
+                self.new_samples.extend((person[0], image) for image in images)
+
+            while len(self.people) > self.capacity:
+                _, (label, _, _) = self.people.popitem(last=False)
+                del self.labels[label]
+                self.retrain = True
+
+    def predict(self, crop):
+        '''Return (username, fullname, distance) of a confident match, or None'''
+        image = self.prepare(crop)
+        with self.lock:
+            self.update_model()
+            if self.model is None:
+                return None
+            label, distance = self.model.predict(image)
+            username = self.labels.get(label)
+            if username is None or distance > self.threshold:
+                return None
+            self.people.move_to_end(username)
+            return username, self.people[username][1], distance
+
+    def update_model(self):
+        if self.retrain or self.model is None:
+            images = [(label, image) for label, _, samples in self.people.values() for image in samples]
+            self.new_samples = []
+            self.retrain = False
+            self.stale = 0
+            if len(images) == 0:
+                self.model = None
+                return
+            self.model = cv2.face.LBPHFaceRecognizer_create()
+            self.model.train([image for _, image in images], numpy.array([label for label, _ in images]))
+        elif len(self.new_samples) > 0:
+            self.model.update([image for _, image in self.new_samples], numpy.array([label for label, _ in self.new_samples]))
+            self.new_samples = []
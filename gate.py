@@ -0,0 +1,181 @@
+# the gate flow shared by the screen and the headless stations: barcode or face -> authenticate -> ESD test -> gate
+#
+# the station shows the progress through its hooks: on_scan(code), on_test(), on_feet(), on_unauthorized(username),
+# on_result(passed), on_refresh() and on_restart(rss)
+
+import time
+import logging
+import metrics
+from config import *
+
+ESD_TEST_SECONDS = metrics.histogram('esd_test_seconds', 'Duration of ESD tests by result', ('result',), (0.5, 1, 1.5, 2, 3, 5, 7, 10))
+
+info_log = logging.getLogger('info')
+error_log = logging.getLogger('error')
+result_log = logging.getLogger('result')
+
+def no_user():
+    return { "username": None, "fullname": None, "gender": None, "date_of_birth": None }
+
+class Gate():
+
+    def __init__(self, station, io, machine, modes, sensors, auth, outbox, uploader):
+        self.station = station
+        self.io = io
+        self.machine = machine
+        self.scheduler = machine.scheduler
+        # the station's mode enum, with BARCODE_SCAN, ESD_TEST and IDLE members
+        self.modes = modes
+        # latest level of each foot sensor, kept by the station's event loop
+        self.sensors = sensors
+        self.auth = auth
+        # results are stored locally first and replayed to the server in background
+        self.outbox = outbox
+        self.uploader = uploader
+
+        self.user = no_user()
+        # "barcode" or "face_id"
+        self.test_type = None
+        self.left_foot = None
+        self.right_foot = None
+        self.esd_testing = False
+        # when the running ESD test started and whether both feet may pass it yet
+        self.esd_started = None
+        self.esd_min_passed = False
+        self.is_gate_opened = False
+
+        machine.timeout(modes.ESD_TEST, ESD_MIN_DURATION, "esd_check")
+        machine.timeout(modes.ESD_TEST, ESD_TEST_TIMEOUT, "esd_timeout")
+        machine.timeout(modes.IDLE, RESULT_DISPLAY_TIME, "refresh")
+        machine.on(None, "barcode", self.handle_barcode)
+        machine.on(modes.ESD_TEST, ("left_foot", "right_foot", "auth"), self.handle_esd_test)
+        machine.on(modes.ESD_TEST, "esd_check", self.esd_check)
+        machine.on(modes.ESD_TEST, "esd_timeout", self.esd_test_failed)
+        machine.on(modes.IDLE, "refresh", self.refresh)
+        machine.on(None, "memory", self.handle_memory)
+
+    def refresh(self, value=None):
+        # forget the last user, unless someone is being tested
+        if self.esd_testing:
+            return
+        self.user = no_user()
+        self.left_foot = None
+        self.right_foot = None
+        self.machine.enter(self.modes.BARCODE_SCAN)
+        self.station.on_refresh()
+
+    def handle_barcode(self, scan):
+        code, input_time = scan
+        self.station.on_scan(code)
+        self.start_test(code, code, "barcode", input_time)
+
+    def start_test(self, username, fullname, test_type, input_time=None):
+        '''Authenticate username in background and test the ESD meanwhile, input_time is when the scan was completed'''
+        self.user = dict(no_user(), username=username, fullname=fullname)
+        self.test_type = test_type
+        self.auth.authenticate(username, input_time)
+        self.esd_started = time.time()
+        self.esd_min_passed = False
+        self.esd_testing = True
+        # entering the mode (again) arms the minimum duration and the timeout of the test
+        self.machine.enter(self.modes.ESD_TEST)
+        self.station.on_test()
+        self.handle_esd_test()
+
+    def check_authentication(self):
+        '''Return True if authorized, False if unauthorized or None while the request is pending'''
+        authorized, json = self.auth.check()
+        if authorized == False:
+            self.user["username"] = None
+        elif json is not None:
+            self.user["username"] = json["username"]
+            self.user["fullname"] = json["fullname"]
+            self.user["gender"] = json.get("gender")
+            self.user["date_of_birth"] = json.get("date_of_birth")
+        return authorized
+
+    def handle_esd_test(self, value=None):
+        # evaluated on every sensor or authentication event during the test
+        if not self.esd_testing:
+            return
+        # return 0 if sensor detected light
+        self.left_foot = not self.sensors["left_foot"]
+        self.right_foot = not self.sensors["right_foot"]
+        self.station.on_feet()
+
+        username = self.user["username"]
+        authorized = self.check_authentication()
+        if (authorized == False):
+            self.esd_testing = False
+            info_log.info('Unauthorized ' + str(username))
+            self.station.on_unauthorized(username)
+            self.machine.enter(self.modes.IDLE, refresh=UNAUTHORIZED_DISPLAY_TIME)
+            return
+
+        # the gate opens once both the authentication and the sensors passed
+        if (authorized == True and self.user["username"] is not None):
+            if (self.left_foot == True and self.right_foot == True and self.esd_min_passed):
+                self.esd_testing = False
+                duration = self.esd_duration()
+                # the gate and the feedback first, recording the result can wait for them
+                self.open_gate()
+                self.show_result(True)
+                self.save_result(duration, "passed")
+
+    def esd_check(self, value=None):
+        # both feet have had the time to pass
+        self.esd_min_passed = True
+        self.handle_esd_test()
+
+    def esd_test_failed(self, value=None):
+        self.esd_testing = False
+        duration = self.esd_duration()
+        self.show_result(False)
+        self.save_result(duration, "failed")
+
+    def show_result(self, passed):
+        # keep the result for a while, then refresh
+        self.station.on_result(passed)
+        self.machine.enter(self.modes.IDLE, refresh=RESULT_DISPLAY_TIME)
+
+    def esd_duration(self):
+        return round(time.time() - self.esd_started, 2)
+
+    def save_result(self, duration, result):
+        data = {
+            "username": self.user["username"],
+            "fullname": self.user["fullname"],
+            "type": self.test_type,
+            "duration": duration,
+            "result": result,
+            "machine": MACHINE
+        }
+
+        ESD_TEST_SECONDS.labels(result).observe(duration)
+        info_log.info("{0}({1}) - mode:{2} - duration:{3} - result:{4} - machine:{5}".format(data["username"], data["fullname"], data["type"], data["duration"], data["result"], data["machine"]))
+        result_log.info("esd result", extra={ "data": data })
+        # save the result locally, the uploader sends it to the server
+        try:
+            self.outbox.put(data)
+        except Exception as e:
+            error_log.exception(e, exc_info=True)
+        self.uploader.notify()
+
+    def open_gate(self):
+        self.is_gate_opened = True
+        self.io.output(GATE_RELAY_PIN, 1)
+        # keep the gate open for GATE_TIMEOUT from the latest opening
+        self.scheduler.call_later("close_gate", GATE_TIMEOUT, self.close_gate)
+
+    def close_gate(self):
+        if (self.is_gate_opened):
+            self.io.output(GATE_RELAY_PIN, 0)
+            self.is_gate_opened = False
+
+    def handle_memory(self, rss):
+        # never in the middle of a test or with the gate open, try again once the station is idle
+        if self.esd_testing or self.is_gate_opened or self.machine.mode != self.modes.BARCODE_SCAN:
+            self.scheduler.call_later("memory_restart", 5, self.handle_memory, rss)
+            return
+        info_log.info('restarting to free memory, {0} MB resident'.format(rss >> 20))
+        self.station.on_restart(rss)
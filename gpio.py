@@ -0,0 +1,167 @@
+# edge triggered GPIO inputs with software debouncing, delivered as events through a queue
+
+import time
+import json
+import logging
+import threading
+
+error_log = logging.getLogger('error')
+
+class GpioInput(threading.Thread):
+
+    def __init__(self, io, events):
+        threading.Thread.__init__(self, name='gpio-input', daemon=True)
+        self.io = io
+        # (name, level) tuples are put here once a pin has settled on a new level
+        self.events = events
+        self.cond = threading.Condition()
+        # pin -> [name, debounce, settled level, time of the last raw edge or None]
+        self.pins = {}
+        self.stopped = False
+
+    def watch(self, pin, name, debounce=0.05):
+        '''Report level changes of pin that hold for at least debounce seconds'''
+        level = bool(self.io.input(pin))
+        with self.cond:
+            self.pins[pin] = [name, debounce, level, None]
+        self.io.add_event_detect(pin, self.io.BOTH, callback=self.on_edge)
+        return level
+
+    def level(self, pin):
+        with self.cond:
+            return self.pins[pin][2]
+
+    def on_edge(self, pin):
+        # called on the GPIO library thread, only remember when the pin last moved
+        with self.cond:
+            self.pins[pin][3] = time.monotonic()
+            self.cond.notify()
+
+    def run(self):
+        with self.cond:
+            while not self.stopped:
+                now = time.monotonic()
+                deadline = None
+                for pin, state in self.pins.items():
+                    name, debounce, level, edge = state
+                    if edge is None:
+                        continue
+                    if now - edge < debounce:
+                        deadline = edge + debounce if deadline is None else min(deadline, edge + debounce)
+                        continue
+
+                    # the pin has been quiet long enough, take its level as settled
+                    state[3] = None
+                    try:
+                        new_level = bool(self.io.input(pin))
+                    except Exception as e:
+                        error_log.exception(e, exc_info=True)
+                        continue
+                    if new_level != level:
+                        state[2] = new_level
+                        self.events.put((name, new_level))
+
+                self.cond.wait(None if deadline is None else deadline - now)
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+        for pin in list(self.pins):
+            try:
+                self.io.remove_event_detect(pin)
+            except Exception:
+                pass
+
+class FakeGPIO():
+    '''Stand-in for RPi.GPIO whose inputs are set by hand or by a scripted timeline'''
+
+    BCM = 11
+    BOARD = 10
+    IN = 1
+    OUT = 0
+    LOW = 0
+    HIGH = 1
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+
+    def __init__(self, initial=None):
+        self.lock = threading.Lock()
+        self.levels = dict(initial or {})
+        self.callbacks = {}
+        # called with (pin, level) whenever an output is written
+        self.output_listeners = []
+
+    def setwarnings(self, flag):
+        pass
+
+    def setmode(self, mode):
+        pass
+
+    def setup(self, pin, direction, pull_up_down=None, initial=0):
+        with self.lock:
+            self.levels.setdefault(pin, initial)
+
+    def cleanup(self, pins=None):
+        pass
+
+    def input(self, pin):
+        with self.lock:
+            return self.levels.get(pin, 0)
+
+    def output(self, pin, level):
+        with self.lock:
+            self.levels[pin] = level
+        for listener in list(self.output_listeners):
+            listener(pin, level)
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        with self.lock:
+            self.callbacks[pin] = callback
+
+    def remove_event_detect(self, pin):
+        with self.lock:
+            self.callbacks.pop(pin, None)
+
+    def set_input(self, pin, level):
+        with self.lock:
+            changed = self.levels.get(pin) != level
+            self.levels[pin] = level
+            callback = self.callbacks.get(pin)
+        if changed and callback is not None:
+            callback(pin)
+
+    def play(self, events):
+        '''Apply (seconds, pin, level) events relative to now on a background thread'''
+        def run():
+            started = time.monotonic()
+            for at, pin, level in sorted(events):
+                delay = started + at - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                self.set_input(int(pin), int(level))
+        thread = threading.Thread(target=run, name='gpio-script', daemon=True)
+        thread.start()
+        return thread
+
+def load_gpio(backend, script=None):
+    '''Return the RPi.GPIO module or, for the "fake" backend, a FakeGPIO playing the JSON script'''
+    if backend != 'fake':
+        import RPi.GPIO
+        return RPi.GPIO
+
+    initial = {}
+    events = []
+    if script is not None:
+        with open(script, 'r') as f:
+            data = json.load(f)
+        initial = dict((int(pin), level) for pin, level in data.get("initial", {}).items())
+        events = data.get("events", [])
+    io = FakeGPIO(initial)
+    if len(events) > 0:
+        io.play(events)
+    return io
@@ -0,0 +1,201 @@
+# gate controller without a screen: barcode -> authenticate -> ESD test -> gate, with a buzzer and LEDs for feedback
+#
+#   python3 main.py --headless < /dev/tty1
+#
+# only the standard library, requests and the GPIO backend are loaded, no Tk, PIL or OpenCV
+
+import sys
+import time
+import queue
+import signal
+import logging
+import threading
+from enum import Enum
+import metrics
+import profiler
+from config import *
+from auth import Authenticator
+from gate import Gate
+from gpio import GpioInput, load_gpio
+from logconf import station_logs
+from memwatch import MemoryWatchdog
+from outbox import Outbox, ResultUploader
+from roster import Roster, RosterSync
+from scanner import start_scanners
+from scheduler import Scheduler, StateMachine
+
+info_log = logging.getLogger('info')
+error_log = logging.getLogger('error')
+
+class GateMode(Enum):
+    IDLE = "ideal"
+    BARCODE_SCAN = "barcode_scan"
+    ESD_TEST = "esd_test"
+
+class LineScanner(threading.Thread):
+
+    def __init__(self, stream, events):
+        threading.Thread.__init__(self, name='line-scanner', daemon=True)
+        # a scanner in keyboard mode ends every code with Enter
+        self.stream = stream
+        self.events = events
+
+    def run(self):
+        for line in self.stream:
+            code = line.strip()
+            if len(code) > 0:
+                self.events.put(("barcode", (code, time.monotonic())))
+        info_log.info('scanner input closed')
+
+class Feedback():
+
+    def __init__(self, io, scheduler):
+        self.io = io
+        self.scheduler = scheduler
+
+    def beep(self, count=1):
+        self.io.output(BUZZER_PIN, 1)
+        self.scheduler.call_later("buzzer", FEEDBACK_TIME, self.beep_off, count - 1)
+
+    def beep_off(self, remaining):
+        self.io.output(BUZZER_PIN, 0)
+        if remaining > 0:
+            self.scheduler.call_later("buzzer", FEEDBACK_TIME, self.beep, remaining)
+
+    def show(self, passed):
+        '''Light the passed or the failed LED, None turns both off'''
+        self.io.output(LED_PASSED_PIN, 1 if passed == True else 0)
+        self.io.output(LED_FAILED_PIN, 1 if passed == False else 0)
+
+class HeadlessStation():
+
+    def __init__(self, io, scanner_input):
+        self.io = io
+        io.setwarnings(False)
+        io.setmode(io.BCM)
+        io.setup(LIGHT_SENSOR_LEFT_PIN, io.IN) #Left light sensor
+        io.setup(LIGHT_SENSOR_RIGHT_PIN, io.IN) #Right light sensor
+        io.setup(GATE_RELAY_PIN, io.OUT) #Gate relay
+        io.setup(BUZZER_PIN, io.OUT) #Buzzer
+        io.setup(LED_PASSED_PIN, io.OUT) #Passed LED
+        io.setup(LED_FAILED_PIN, io.OUT) #Failed LED
+
+        # scanner, sensor and authentication events, handled one at a time by run
+        self.events = queue.Queue()
+        self.scheduler = Scheduler()
+        self.machine = StateMachine(self.scheduler, GateMode.BARCODE_SCAN)
+        self.feedback = Feedback(io, self.scheduler)
+        self.stopped = threading.Event()
+        # nonzero when the station stops to be restarted
+        self.exit_code = 0
+
+        self.roster = None
+        self.roster_sync = None
+        if ROSTER_SYNC_INTERVAL is not None:
+            self.roster = Roster(ROSTER_FILE, ROSTER_MAX_AGE)
+            self.roster_sync = RosterSync(self.roster, API_URL + '/esd/roster', ROSTER_SYNC_TIMEOUT, ROSTER_SYNC_INTERVAL)
+            self.roster_sync.start()
+        self.auth = Authenticator(API_URL + '/esd/authenticate', REQUEST_TIMEOUT, self.events, self.roster)
+        self.outbox = Outbox(OUTBOX_FILE, OUTBOX_RETENTION)
+        self.outbox.import_legacy(DIR_NAME + '/records.txt')
+        self.uploader = ResultUploader(self.outbox, API_URL + '/esd/save', REQUEST_TIMEOUT, UPLOAD_BATCH_SIZE)
+        self.uploader.start()
+
+        self.gpio = GpioInput(io, self.events)
+        self.sensors = {
+            "left_foot": self.gpio.watch(LIGHT_SENSOR_LEFT_PIN, "left_foot", FOOT_DEBOUNCE),
+            "right_foot": self.gpio.watch(LIGHT_SENSOR_RIGHT_PIN, "right_foot", FOOT_DEBOUNCE)
+        }
+        self.gpio.start()
+        # the same flow as the screen station, with the buzzer and the LEDs for feedback
+        self.gate = Gate(self, io, self.machine, GateMode, self.sensors, self.auth, self.outbox, self.uploader)
+        self.memory = MemoryWatchdog(self.events, MEMORY_CHECK_INTERVAL, MEMORY_WARMUP, MEMORY_LIMIT_MB << 20, MEMORY_GROWTH_MB << 20, MEMORY_ACTION, MEMORY_TRACE_FRAMES)
+        self.memory.start()
+        # scanner devices when configured, else codes typed on the console
+        self.scanners = start_scanners(SCANNER_DEVICES, self.events, SCANNER_MAX_GAP, SCANNER_MIN_LENGTH)
+        if len(self.scanners) == 0:
+            LineScanner(scanner_input, self.events).start()
+        self.gate.refresh()
+
+    def run(self):
+        while not self.stopped.is_set():
+            delay = self.scheduler.run_pending()
+            # nothing else can happen before the next task, sleep on the event queue until then
+            try:
+                name, value = self.events.get(timeout=1 if delay is None else min(1, delay))
+            except queue.Empty:
+                continue
+
+            if name in self.sensors:
+                self.sensors[name] = value
+            try:
+                self.machine.dispatch(name, value)
+            except Exception as e:
+                error_log.exception(e, exc_info=True)
+        self.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.events.put(("quit", None))
+
+    def close(self):
+        self.gate.close_gate()
+        self.feedback.show(None)
+        self.io.output(BUZZER_PIN, 0)
+        self.uploader.stop()
+        self.gpio.stop()
+        self.memory.stop()
+        self.auth.close()
+        for scanner in self.scanners:
+            scanner.stop()
+        if self.roster_sync is not None:
+            self.roster_sync.stop()
+
+    def on_scan(self, code):
+        self.feedback.beep()
+
+    def on_test(self):
+        pass
+
+    def on_feet(self):
+        pass
+
+    def on_unauthorized(self, username):
+        self.feedback.show(False)
+        self.feedback.beep(3)
+
+    def on_result(self, passed):
+        self.feedback.show(passed)
+        self.feedback.beep(1 if passed else 3)
+
+    def on_refresh(self):
+        self.feedback.show(None)
+
+    def on_restart(self, rss):
+        # the supervisor starts the station again
+        self.exit_code = 1
+        self.stop()
+
+def main():
+    logs = station_logs(DIR_NAME + '/logs', LOG_QUEUE_SIZE, LOG_MAX_BYTES, LOG_BACKUP_COUNT, LOG_ROTATE_INTERVAL)
+    if METRICS_PORT is not None:
+        try:
+            metrics.start_server(METRICS_PORT)
+        except OSError as e:
+            error_log.exception(e, exc_info=True)
+    if METRICS_FILE is not None:
+        metrics.start_file_writer(METRICS_FILE, METRICS_FILE_INTERVAL)
+
+    profiler.install(DIR_NAME + '/logs', PROFILE_SECONDS)
+    station = HeadlessStation(load_gpio(GPIO_BACKEND, GPIO_SCRIPT), sys.stdin)
+    signal.signal(signal.SIGTERM, lambda signum, frame: station.stop())
+    signal.signal(signal.SIGINT, lambda signum, frame: station.stop())
+    info_log.info('headless gate controller started')
+    try:
+        station.run()
+    finally:
+        logs.stop()
+    return station.exit_code
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,35 @@
+# heavy modules imported on first use or warmed up in background, so the window shows up first
+
+import logging
+import importlib
+import threading
+
+error_log = logging.getLogger('error')
+
+class LazyModule():
+    '''Stands in for a module and imports it on first attribute access'''
+
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def load(self):
+        if self.module is None:
+            # the import lock makes concurrent first uses wait for one import
+            self.module = importlib.import_module(self.name)
+        return self.module
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+def prewarm(*modules):
+    '''Import the lazy modules on a background thread'''
+    def run():
+        for module in modules:
+            try:
+                module.load()
+            except Exception as e:
+                error_log.exception(e, exc_info=True)
+    thread = threading.Thread(target=run, name='prewarm', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,104 @@
+# non-blocking logging: callers only put records on a queue, a background listener writes them to rotated files
+
+import os
+import gzip
+import json
+import time
+import queue
+import shutil
+import logging
+import logging.handlers
+import metrics
+
+LOG_RECORDS_DROPPED = metrics.counter('esd_log_records_dropped_total', 'Log records dropped because the log queue was full')
+
+TEXT_FORMAT = '%(asctime)s : %(levelname)-8s - %(message)s'
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+
+    def enqueue(self, record):
+        # never block the caller, a full queue means the disk can't keep up
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+
+class RotatingCompressedFileHandler(logging.handlers.RotatingFileHandler):
+    '''Rotate when the file reaches max_bytes or is older than interval seconds, old files are gzipped'''
+
+    def __init__(self, file_name, max_bytes, backup_count, interval=None):
+        dirname = os.path.dirname(file_name)
+        if len(dirname) > 0 and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        logging.handlers.RotatingFileHandler.__init__(self, file_name, 'a', max_bytes, backup_count, 'utf-8')
+        self.interval = interval
+        self.opened = os.path.getmtime(file_name) if os.path.exists(file_name) and os.path.getsize(file_name) > 0 else time.time()
+        self.namer = lambda name: name + '.gz'
+        self.rotator = self.compress
+
+    def compress(self, source, dest):
+        with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.remove(source)
+
+    def shouldRollover(self, record):
+        if self.interval is not None and time.time() - self.opened >= self.interval:
+            return True
+        return logging.handlers.RotatingFileHandler.shouldRollover(self, record)
+
+    def doRollover(self):
+        logging.handlers.RotatingFileHandler.doRollover(self)
+        self.opened = time.time()
+
+class JsonFormatter(logging.Formatter):
+    '''One JSON object per line, the record's data (passed as extra) merged in'''
+
+    def format(self, record):
+        line = { "time": self.formatTime(record, '%Y-%m-%dT%H:%M:%S'), "level": record.levelname, "message": record.getMessage() }
+        line.update(getattr(record, 'data', {}))
+        if record.exc_info:
+            line["exception"] = self.formatException(record.exc_info)
+        return json.dumps(line, ensure_ascii=False)
+
+class LogPipeline():
+
+    def __init__(self, queue_size=10000):
+        self.queue = queue.Queue(queue_size)
+        self.handlers = []
+        self.listener = None
+
+    def add(self, log_name, file_name, level, formatter, max_bytes, backup_count, interval=None):
+        '''Write the records of log_name to file_name on the listener thread'''
+        handler = RotatingCompressedFileHandler(file_name, max_bytes, backup_count, interval)
+        handler.setFormatter(formatter)
+        handler.setLevel(level)
+        # the listener passes every record to every handler, keep each file to its own logger
+        handler.addFilter(lambda record: record.name == log_name)
+        self.handlers.append(handler)
+
+        logger = logging.getLogger(log_name)
+        logger.setLevel(level)
+        logger.propagate = False
+        logger.addHandler(DroppingQueueHandler(self.queue))
+        return logger
+
+    def start(self):
+        self.listener = logging.handlers.QueueListener(self.queue, *self.handlers, respect_handler_level=True)
+        self.listener.start()
+
+    def stop(self):
+        '''Write out the queued records and close the files'''
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+        for handler in self.handlers:
+            handler.close()
+
+def station_logs(log_dir, queue_size, max_bytes, backup_count, interval):
+    '''Start the info, error and result (one JSON line per ESD result) logs of a station'''
+    logs = LogPipeline(queue_size)
+    logs.add('info', log_dir + '/info.log', logging.INFO, logging.Formatter(TEXT_FORMAT), max_bytes, backup_count, interval)
+    logs.add('error', log_dir + '/error.log', logging.ERROR, logging.Formatter(TEXT_FORMAT), max_bytes, backup_count, interval)
+    logs.add('result', log_dir + '/results.jsonl', logging.INFO, JsonFormatter(), max_bytes, backup_count, interval)
+    logs.start()
+    return logs
@@ -1,57 +1,57 @@
 #!/usr/bin/env python3
 
+import sys
+
+# gates without a screen run the same flow without loading Tk or OpenCV
+if __name__ == "__main__" and "--headless" in sys.argv[1:]:
+    import headless
+    sys.exit(headless.main())
+
 import tkinter as tk
 from tkinter import font as tkfont
 from tkinter.messagebox import showinfo
 from PIL import Image, ImageTk
 from enum import Enum
-import RPi.GPIO as IO
 import os
-import cv2
 import math
 import logging
-import requests
-import grequests
-import base64
 import time
 import datetime
 import random
 import queue
+import collections
 import threading
-
-# module attached
-IR_SENSOR_PIN = 5
-LIGHT_SENSOR_LEFT_PIN = 14
-LIGHT_SENSOR_RIGHT_PIN = 15
-GATE_RELAY_PIN = 18
-
-# main config
-DIR_NAME = os.path.dirname(os.path.abspath(__file__))
-API_URL = 'http://172.16.65.18:8989/api'
-MACHINE = 'ESD-[Station]'
-REQUEST_TIMEOUT = 1 #seconds
-GATE_TIMEOUT = 7 #seconds
-RECOGNIZE_TIMEOUT = 3 #seconds
-CAMERA_TIMEOUT = 300 #seconds
-BARCODE_SCAN_TIMEOUT = 10 #seconds
-ESD_TEST_TIMEOUT = 7 #seconds
-
-def setup_log(log_name, file_name, level=logging.INFO):
-    dirname = os.path.dirname(file_name)
-    if len(dirname) > 0 and not os.path.exists(dirname):
-        os.makedirs(dirname)
-
-    handler = logging.FileHandler(file_name, 'a', 'utf-8')
-    handler.setFormatter(logging.Formatter('%(asctime)s : %(levelname)-8s - %(message)s'))
-
-    logger = logging.getLogger(log_name)
-    logger.setLevel(level)
-    logger.addHandler(handler)
-    return logger
-
-# logger
-info_log = setup_log('info', DIR_NAME + '/logs/info.log', logging.INFO)
-error_log = setup_log('error', DIR_NAME + '/logs/error.log', logging.ERROR)
+import metrics
+from outbox import Outbox, ResultUploader
+from camera import FrameBuffer, CameraStream
+from face import FaceDetector, LocalRecognizer, perceptual_hash
+from recognition import RecognitionClient, RateController, ResponseCache, EvidenceAccumulator
+from gpio import GpioInput, load_gpio
+from scheduler import Scheduler, StateMachine
+from lazy import LazyModule, prewarm
+import profiler
+from profiler import span
+from auth import Authenticator
+from gate import Gate
+from roster import Roster, RosterSync
+from scanner import start_scanners
+from logconf import station_logs
+from memwatch import MemoryWatchdog
+from config import *
+
+# OpenCV takes seconds to import on a Pi, it is loaded in background once the window is up
+cv2 = LazyModule('cv2')
+
+RENDER_SECONDS = metrics.histogram('esd_render_seconds', 'Time to put a camera frame on screen')
+FRAMES_SKIPPED = metrics.counter('esd_face_frames_skipped_total', 'Camera frames not uploaded because no face was detected')
+LOCAL_FACE_MATCHES = metrics.counter('esd_face_local_matches_total', 'Faces recognized by the station without asking the server')
+
+IO = load_gpio(GPIO_BACKEND, GPIO_SCRIPT)
+
+# logger, the files are written by a background thread
+LOGS = station_logs(DIR_NAME + '/logs', LOG_QUEUE_SIZE, LOG_MAX_BYTES, LOG_BACKUP_COUNT, LOG_ROTATE_INTERVAL)
+info_log = logging.getLogger('info')
+error_log = logging.getLogger('error')
 
 class App(tk.Tk):
 
@@ -64,12 +64,19 @@ class App(tk.Tk):
         IO.setup(LIGHT_SENSOR_RIGHT_PIN, IO.IN) #Right light sensor
         IO.setup(GATE_RELAY_PIN, IO.OUT) #Gate relay
 
-        self.user = { "username": None, "fullname": None, "gender": None, "date_of_birth": None }
-        self.test_type = None
-        self.result = None
-        self.new_input = False
+        # local metrics endpoint and/or file
+        if METRICS_PORT is not None:
+            try:
+                metrics.start_server(METRICS_PORT)
+            except OSError as e:
+                error_log.exception(e, exc_info=True)
+        if METRICS_FILE is not None:
+            metrics.start_file_writer(METRICS_FILE, METRICS_FILE_INTERVAL)
+
         self.input_text = ""
         self.mode = AppMode.BARCODE_SCAN
+        # nonzero when the station quits to be restarted
+        self.exit_code = 0
 
         self.title("GUI")
         self.geometry("900x600")
@@ -98,7 +105,10 @@ class App(tk.Tk):
             frame.grid(row=0, column=0, sticky="nsew")
 
         self.show_frame("MainPage")
-        self.bind('<Key>', self.read_key)
+        # scanners are read from their devices when configured, otherwise they type into the window
+        self.scanners = start_scanners(SCANNER_DEVICES, self.frames["MainPage"].events, SCANNER_MAX_GAP, SCANNER_MIN_LENGTH)
+        if len(self.scanners) == 0:
+            self.bind('<Key>', self.read_key)
 
     def show_frame(self, page_name):
         '''Show a frame for the given page name'''
@@ -112,22 +122,32 @@ class App(tk.Tk):
                     self.input_text = ""
                 self.input_text += event.char
             else:
-                self.user["username"] = self.input_text
-                self.user["fullname"] = self.input_text
+                code = self.input_text
                 self.input_text = ""
-                self.new_input = True
-                self.result = True
-                self.test_type = "barcode"
-                self.mode = AppMode.ESD_TEST
-        except: pass
+                self.frames["MainPage"].machine.dispatch("barcode", (code, time.monotonic()))
+        except Exception as e:
+            error_log.exception(e, exc_info=True)
 
     def quit(self):
         self.mode = AppMode.QUIT
+        for scanner in self.scanners:
+            scanner.stop()
+        self.frames["MainPage"].uploader.stop()
+        self.frames["MainPage"].recognizer.close()
+        self.frames["MainPage"].gpio.stop()
+        self.frames["MainPage"].auth.close()
+        if self.frames["MainPage"].roster_sync is not None:
+            self.frames["MainPage"].roster_sync.stop()
+        self.frames["MainPage"].memory.stop()
+        if self.frames["MainPage"].camera is not None:
+            self.frames["MainPage"].camera.stop()
         # destroy each frame first 
         for frame in list(self.frames):
             del self.frames[frame]
         # destroy the app
         self.destroy()
+        # write out the queued log records
+        LOGS.stop()
 
 class AppMode(Enum):
     IDLE = "ideal"
@@ -144,140 +164,241 @@ class MainPage(tk.Frame):
         self.controller = controller
         self.width = 900
         self.height = 600
-        # timer for turning on/off camera
-        self.cam_timer = Timer(1)
-        # timer for each request will be sent to the server
-        self.dur_timer = Timer()
-        # timer for turning off camera when nothing detected
-        self.face_timer = Timer(CAMERA_TIMEOUT)
-        # the timeout for each face recognition
-        self.recog_timer = Timer(RECOGNIZE_TIMEOUT)
-        # the timeout for scanning barcode
-        self.barcode_timer = Timer(BARCODE_SCAN_TIMEOUT)
-        # the timeout for testing ESD
-        self.esd_timer = Timer(ESD_TEST_TIMEOUT)
-        # timer for refreshing GUI while idling
-        self.refresh_timer = Timer()
-        # the timeout for opening the gate
-        self.gate_timer = Timer(GATE_TIMEOUT)
-        # handle image queue
-        self.req_queue = queue.Queue()
+        # sensor, authentication and recognition events for the Tk thread
+        self.events = queue.Queue()
+        # every timeout and periodic task of the page runs from one scheduler tick
+        self.scheduler = Scheduler()
+        # what each mode does with each event, mode timeouts are cancelled when the mode is left
+        self.machine = StateMachine(self.scheduler, controller.mode, self.set_mode)
+        self.machine.timeout(AppMode.FACE_RECOGNIZE, RECOGNIZE_TIMEOUT, "recognize_timeout")
+        self.machine.on(None, "motion", self.handle_motion)
+        self.machine.on((AppMode.BARCODE_SCAN, AppMode.FACE_RECOGNIZE, AppMode.IDLE), "face", self.handle_face)
+        self.machine.on((AppMode.BARCODE_SCAN, AppMode.FACE_RECOGNIZE), "face_error", self.use_barcode)
+        self.machine.on(AppMode.FACE_RECOGNIZE, "recognize_timeout", self.recognize_failed)
+        # latest camera frame, shared by the display and the recognition
+        self.frame_buffer = FrameBuffer()
+        self.camera = None
+        # sequence number of the frame on screen
+        self.display_seq = 0
+        # the frame on screen, resized and in RGB
+        self.display_bgr = None
+        self.display_rgb = None
+        # only frames with a face are sent to the server, loaded by the handle image thread
+        self.detector = None
+        # employees the server recognized lately are recognized locally, loaded by the handle image thread
+        self.local_faces = None
+        # (username, crop) of the frames the server matched, local_faces learns those of the employee the evidence commits to
+        self.recent_crops = collections.deque(maxlen=LOCAL_FACE_SAMPLES)
         # handle image thread
-        self.req_thread = threading.Thread(target=self.observe_req_queue)
-        self.recognizing = False
+        self.req_thread = threading.Thread(target=self.observe_frames, daemon=True)
         self.data = { "title": "Welcome to Spartronics VN", "message": "Chúc bạn một ngày làm việc vui vẻ!" }
         self.camera_on = False
-        self.left_foot = None
-        self.right_foot = None
-        self.esd_testing = False
-        self.is_gate_opened = False
-        # store all requests in a list and send to server interval time
-        self.req_list = []
-        # count the frame will be store in request list
-        self.frame_count = 0
-
+        # face frames are posted over keep-alive connections, superseded frames are dropped
+        self.upload_rate = RateController(FACE_MIN_RATE, FACE_MAX_RATE, FACE_RATE_STEP, FACE_TARGET_LATENCY, FACE_QUALITY_LEVELS, FACE_MIN_TIMEOUT, FACE_MAX_TIMEOUT)
+        # answers over successive frames decide who is in front of the camera
+        self.evidence = EvidenceAccumulator(FACE_MATCH_EVIDENCE, FACE_UNKNOWN_EVIDENCE, FACE_EVIDENCE_HALF_LIFE, FACE_UNKNOWN_WINDOW, FACE_UNKNOWN_SHARE)
+        # a person standing still is answered from the answers to their previous frames
+        self.face_cache = ResponseCache(FACE_CACHE_TTL, FACE_CACHE_SIZE, FACE_CACHE_DISTANCE) if FACE_CACHE_TTL > 0 else None
+        self.recognizer = RecognitionClient(API_URL + "/face", self.upload_rate, FACE_MAX_INFLIGHT, FACE_UPLOAD_FORMAT, FACE_FRAMES_PER_REQUEST, self.face_cache)
+        # results are stored locally first and replayed to the server in background
+        self.outbox = Outbox(OUTBOX_FILE, OUTBOX_RETENTION)
+        self.outbox.import_legacy(DIR_NAME + '/records.txt')
+        self.uploader = ResultUploader(self.outbox, API_URL + '/esd/save', REQUEST_TIMEOUT, UPLOAD_BATCH_SIZE)
+        self.uploader.start()
+        # authentication runs in background while the ESD sensors are sampled, the local roster answers first
+        self.roster = None
+        self.roster_sync = None
+        if ROSTER_SYNC_INTERVAL is not None:
+            self.roster = Roster(ROSTER_FILE, ROSTER_MAX_AGE)
+            self.roster_sync = RosterSync(self.roster, API_URL + '/esd/roster', ROSTER_SYNC_TIMEOUT, ROSTER_SYNC_INTERVAL)
+            self.roster_sync.start()
+        self.auth = Authenticator(API_URL + '/esd/authenticate', REQUEST_TIMEOUT, self.events, self.roster)
+        # a station up for days is restarted before it runs the Pi out of memory
+        self.memory = MemoryWatchdog(self.events, MEMORY_CHECK_INTERVAL, MEMORY_WARMUP, MEMORY_LIMIT_MB << 20, MEMORY_GROWTH_MB << 20, MEMORY_ACTION, MEMORY_TRACE_FRAMES)
+        self.memory.start()
+
+        # resized sprites, the background is kept with its alpha applied
+        self.images = ImageCache(SPRITE_CACHE_SIZE)
         image = Image.open(DIR_NAME + '/img/bg-image.png')
         image.putalpha(192)
-        self.copy_image = image.copy()
-        photo = ImageTk.PhotoImage(image)
+        self.images.add('bg', image)
         self.canvas = tk.Canvas(self)
         self.canvas.pack(fill="both", expand=True)
         self.canvas.bind('<Configure>', self.resize_image)
 
+        # canvas items are created once, rendering only updates them
+        self.bg_item = self.canvas.create_image(0, 0, anchor="nw", tags="bg")
+        self.card_item = self.canvas.create_image(0, 0, anchor="nw", state="hidden", tags="card")
+        self.lfoot_item = self.canvas.create_image(0, 0, anchor="nw", state="hidden", tags="lfoot")
+        self.rfoot_item = self.canvas.create_image(0, 0, anchor="nw", state="hidden", tags="rfoot")
+        self.message_item = self.canvas.create_text(0, 0, text="", fill='RoyalBlue4', font=("Times",32,"bold"), justify="center", anchor="center", tags="message")
+        self.images.warm([DIR_NAME + "/img/" + side + "_" + result + ".png" for side in ("left", "right") for result in ("passed", "failed")], FOOT_SIZE)
+
         self.lmain = tk.Label(self.canvas, text="", font=(None, 20, "italic"), bg="white", fg="black")
+        self.lmain.imgtk = None
         self.lmain.place(relx=0.005, rely=0, y=90, anchor="nw")
         #self.lbarcode = tk.Label(self.canvas, text="<Barcode>", font=(None, 50, "italic"), bg="gold", fg="black")
         #self.lbarcode.place(relx=1.0, rely=1.0, x=-5, y=-5, anchor="se")
 
         self.lmain.bind("<Button-1>", self.open_camera)
         #self.lbarcode.bind("<Button-1>", self.use_barcode)
+        # sensors report level changes through the event queue instead of being polled
+        self.gpio = GpioInput(IO, self.events)
+        self.sensors = {
+            "motion": self.gpio.watch(IR_SENSOR_PIN, "motion", IR_DEBOUNCE),
+            "left_foot": self.gpio.watch(LIGHT_SENSOR_LEFT_PIN, "left_foot", FOOT_DEBOUNCE),
+            "right_foot": self.gpio.watch(LIGHT_SENSOR_RIGHT_PIN, "right_foot", FOOT_DEBOUNCE)
+        }
+        self.gpio.start()
+        # barcode or face -> authentication -> ESD test -> gate, the same flow as the headless station
+        self.gate = Gate(self, IO, self.machine, AppMode, self.sensors, self.auth, self.outbox, self.uploader)
+
         self.use_barcode()
-        self.detect_motion()
-        self.req_thread.start()
+        self.tick()
+        # the window is shown first, then OpenCV is loaded and the camera put in standby
+        self.after(CAMERA_STANDBY_DELAY, self.start_camera)
 
     def render(self):
-        width = self.width
-        height = self.height
-        rs_image = self.copy_image.resize((self.width, self.height))
-        photo = ImageTk.PhotoImage(rs_image)
-        self.canvas.delete('all')
-        self.canvas.create_image(0, 0, image=photo, anchor="nw", tags="bg")
+        photo = self.images.get('bg', (self.width, self.height))
+        self.canvas.itemconfig(self.bg_item, image=photo)
         self.canvas.image = photo #avoid garbage collection
 
         #self.canvas.create_text(width / 2, height / 6, text=self.data["title"], fill='red', font=("fixedsys",50,"bold"), anchor="n", tags="title")
         self.set_message(self.data["message"])
         #self.canvas.create_line(width / 3, height / 3, 2 * width / 3, height / 3)
+        self.render_card(False)
+        self.render_esd_result(True)
 
     def render_card(self, rendered):
         if rendered == True and self.controller.mode == AppMode.BARCODE_SCAN:
-            cardimg = Image.open(DIR_NAME + "/img/verify_card.jpg")
-            cardimg = cardimg.resize((150,200))
-            cardphoto = ImageTk.PhotoImage(cardimg)
-            self.canvas.create_image(self.width/2-75, self.height-200, image=cardphoto, anchor="nw", tags="card")
+            cardphoto = self.images.get(DIR_NAME + "/img/verify_card.jpg", (150, 200))
+            self.canvas.coords(self.card_item, self.width/2-75, self.height-200)
+            self.canvas.itemconfig(self.card_item, image=cardphoto, state="normal")
             self.canvas.cardimage = cardphoto
         else:
-            self.canvas.delete('card')
+            self.canvas.itemconfig(self.card_item, state="hidden")
             self.canvas.cardimage = None
 
     def render_esd_result(self, rendered):
-        self.canvas.delete('rfoot')
-        self.canvas.delete('lfoot')
-
-        if rendered == True and self.controller.mode == AppMode.ESD_TEST and self.left_foot is not None and self.right_foot is not None:
-            pic_w = 200
-            pic_h = 100
+        if rendered == True and self.controller.mode == AppMode.ESD_TEST and self.gate.left_foot is not None and self.gate.right_foot is not None:
+            pic_w, pic_h = FOOT_SIZE
             pic_o = 10
 
-            lfpic = DIR_NAME + "/img/left_" + ("passed" if self.left_foot else "failed") + ".png"
-            lfimg = Image.open(lfpic)
-            lfimg = lfimg.resize((pic_w, pic_h))
-            lfphoto = ImageTk.PhotoImage(lfimg)
-            self.canvas.create_image(self.width - pic_w * 2 - pic_o, self.height - pic_h - pic_o, image=lfphoto, anchor="nw", tags="lfoot")
+            lfphoto = self.images.get(DIR_NAME + "/img/left_" + ("passed" if self.gate.left_foot else "failed") + ".png", FOOT_SIZE)
+            self.canvas.coords(self.lfoot_item, self.width - pic_w * 2 - pic_o, self.height - pic_h - pic_o)
+            self.canvas.itemconfig(self.lfoot_item, image=lfphoto, state="normal")
             self.canvas.lfimg = lfphoto
 
-            rtpic = DIR_NAME + "/img/right_" + ("passed" if self.right_foot else "failed") + ".png"
-            rtimg = Image.open(rtpic)
-            rtimg = rtimg.resize((pic_w, pic_h))
-            rtphoto = ImageTk.PhotoImage(rtimg)
-            self.canvas.create_image(self.width - pic_w - pic_o, self.height - pic_h - pic_o, image=rtphoto, anchor="nw", tags="rfoot")
+            rtphoto = self.images.get(DIR_NAME + "/img/right_" + ("passed" if self.gate.right_foot else "failed") + ".png", FOOT_SIZE)
+            self.canvas.coords(self.rfoot_item, self.width - pic_w - pic_o, self.height - pic_h - pic_o)
+            self.canvas.itemconfig(self.rfoot_item, image=rtphoto, state="normal")
             self.canvas.rtimg = rtphoto
+        else:
+            self.canvas.itemconfig(self.lfoot_item, state="hidden")
+            self.canvas.itemconfig(self.rfoot_item, state="hidden")
+
+    @span('tick')
+    def tick(self):
+        if self.controller.mode == AppMode.QUIT:
+            return
+        delay = None
+        try:
+            self.handle_events()
+            delay = self.scheduler.run_pending()
+        finally:
+            # this is the station's only loop, it goes on whatever failed
+            # wake up for the next task, and at least every TICK_INTERVAL for input events
+            delay = TICK_INTERVAL if delay is None else min(TICK_INTERVAL, int(delay * 1000))
+            self.after(max(1, delay), self.tick)
+
+    @span('handle_events')
+    def handle_events(self):
+        while True:
+            try:
+                name, value = self.events.get_nowait()
+            except queue.Empty:
+                break
 
-    def detect_motion(self):
-        if (IO.input(IR_SENSOR_PIN) == True):
+            if name in self.sensors:
+                self.sensors[name] = value
+            try:
+                self.machine.dispatch(name, value)
+            except Exception as e:
+                error_log.exception(e, exc_info=True)
+
+    def set_mode(self, mode):
+        self.controller.mode = mode
+
+    def handle_motion(self, value):
+        if (value == True):
+            self.open_camera()
+
+    def start_camera(self):
+        prewarm(cv2)
+        self.req_thread.start()
+        if (CAMERA_STANDBY == True and self.camera is None):
+            # keep the device open so waking it up on motion is instant
+            self.camera = CameraStream(CAMERA_SOURCE, self.frame_buffer, CAMERA_STANDBY_FPS, active=False)
+            self.camera.start()
+        if self.sensors["motion"]:
             self.open_camera()
-        self.close_gate()
-        self.after(10, self.detect_motion)
 
     def open_camera(self, event=None):
-        if (self.cam_timer.is_timeout()):
-            if (self.camera_on == False):
-                try:
-                    self.capture = cv2.VideoCapture(0)
-                    self.camera_on = True
-                    self.face_timer.reset()
-                    self.video_stream()
-                    print('open camera ' + str(datetime.datetime.now()))
-                except Exception as e:
-                    self.camera_on = False
-                    error_log.exception(e, exc_info=True)
-                    if (self.controller.mode == AppMode.BARCODE_SCAN):
-                        self.lmain.configure(text="<Camera Failed>", bg='red')
-                        self.use_barcode()
-        else:
-            self.after(100, self.open_camera)
+        if (self.camera_on == True):
+            return
+        if (self.camera is not None and self.camera.failed):
+            # the camera in standby lost its device, open it again
+            self.camera = None
+        if (self.camera is None):
+            cooldown = self.scheduler.remaining("camera_cooldown")
+            if cooldown is not None:
+                # open the camera once it had its rest
+                self.scheduler.call_later("open_camera", cooldown, self.open_camera)
+                return
+            # the device is opened by the capture thread, video_stream picks up its frames
+            self.camera = CameraStream(CAMERA_SOURCE, self.frame_buffer, CAMERA_STANDBY_FPS)
+            self.camera.start()
+
+        self.camera.wake()
+        self.camera_on = True
+        self.keep_camera_on()
+        self.scheduler.call_every("video_stream", 1.0 / CAMERA_FPS, self.video_stream)
+        print('open camera ' + str(datetime.datetime.now()))
+
+    def keep_camera_on(self):
+        # close the camera when no faces were detected for CAMERA_TIMEOUT, safe to call from any thread
+        if (self.camera_on == True):
+            self.scheduler.call_later("camera_timeout", CAMERA_TIMEOUT, self.close_camera)
+
+    def stop_camera(self, release=False):
+        self.camera_on = False
+        self.scheduler.cancel("video_stream")
+        self.scheduler.cancel("camera_timeout")
+        if (CAMERA_STANDBY == True and release == False):
+            self.camera.standby()
+            return
+        self.camera.stop()
+        self.camera = None
+        self.scheduler.call_later("camera_cooldown", CAMERA_COOLDOWN, lambda: None)
+
+    def camera_failed(self):
+        self.stop_camera(release=True)
+        if (self.controller.mode == AppMode.BARCODE_SCAN):
+            self.lmain.configure(text="<Camera Failed>", bg='red')
+            self.use_barcode()
 
     def close_camera(self):
+        if (self.camera_on == False):
+            return
         print('close camera ' + str(datetime.datetime.now()))
-        self.capture.release()
-        self.cam_timer.reset()
-        self.camera_on = False
-        self.motion = False
+        self.stop_camera()
         self.lmain.configure(image = "", text="", bg="white")
         self.lmain.imgtk = None
-        self.refresh()
+        if (self.controller.mode in (AppMode.BARCODE_SCAN, AppMode.FACE_RECOGNIZE)):
+            self.gate.refresh()
 
     def set_state_message(self):
-        name = self.controller.user["fullname"]
+        name = self.gate.user["fullname"]
         name = name if name is not None else ""
         switcher = {
             AppMode.IDLE: "Chúc bạn một ngày làm việc vui vẻ!",
@@ -289,263 +410,237 @@ class MainPage(tk.Frame):
         self.render()
 
     def resize_image(self, event):
+        if (event.width == self.width and event.height == self.height):
+            return
+        # the background of the old size won't be needed again
+        self.images.invalidate('bg')
         self.width = event.width
         self.height = event.height
         self.render()
 
     def set_message(self, message):
         self.data["message"] = message
-        self.canvas.delete('message')
-        self.canvas.create_text(self.width / 3, self.height - 60, text=self.data["message"], fill='RoyalBlue4', font=("Times",32,"bold"), justify="center", anchor="center", tags="message")
-
-    def refresh(self):
-        if self.refresh_timer.is_timeout():
-            # refresh application state if anyone tested
-            if not self.esd_testing:
-                self.controller.user = { "username": None, "fullname": None }
-                self.controller.result = False
-                self.left_foot = None
-                self.right_foot = None
-                self.controller.mode = AppMode.BARCODE_SCAN
-                self.set_state_message()
-
-            self.close_gate()
-        else:
-            self.after(1000, self.refresh)
+        self.canvas.coords(self.message_item, self.width / 3, self.height - 60)
+        self.canvas.itemconfig(self.message_item, text=self.data["message"])
 
-    def open_gate(self):
-        self.gate_timer.reset()
-        self.is_gate_opened = True
-        IO.output(GATE_RELAY_PIN, 1)
+    def show_result(self, message, seconds=RESULT_DISPLAY_TIME):
+        # keep the message on screen for a while, then refresh
+        self.set_message(message)
+        self.machine.enter(AppMode.IDLE, refresh=seconds)
 
-    def close_gate(self):
-        if (self.gate_timer.is_timeout() and self.is_gate_opened):
-            IO.output(GATE_RELAY_PIN, 0)
-            self.is_gate_opened = False
+    # hooks of the gate flow
 
-    def authenticate(self, username):
-        try:
-            if username is None:
-                return False
-
-            res = requests.post(API_URL + '/esd/authenticate', { "username": username }, timeout=REQUEST_TIMEOUT)
-            if (res.status_code == 401):
-                self.set_message('Unauthorized ' + username)
-                self.controller.user["username"] = None
-                self.refresh_timer.set_interval(1)
-                self.after(1000, self.refresh)
-                return False
-            elif (res.status_code == 200):
-                json = res.json()
-                self.controller.user["username"] = json["username"]
-                self.controller.user["fullname"] = json["fullname"]
-                self.controller.user["gender"] = json["gender"]
-                self.controller.user["date_of_birth"] = json["date_of_birth"]
-        except Exception as e:
-            error_log.exception(e, exc_info=True)
-
-        return True
-
-    def handle_barcode(self):
+    def on_scan(self, code):
         #self.render_card(True)
-        if (self.controller.new_input and self.controller.user["username"] is not None):
-            if self.authenticate(self.controller.user["username"]):
-                self.test_esd()
-                self.controller.new_input = False
+        pass
 
-        self.after(100, self.handle_barcode)
-
-    def handle_esd_test(self):
-        # return 0 if sensor detected light
-        self.left_foot = not IO.input(LIGHT_SENSOR_LEFT_PIN)
-        self.right_foot = not IO.input(LIGHT_SENSOR_RIGHT_PIN)
+    def on_test(self):
+        self.set_state_message()
 
+    def on_feet(self):
         self.render_esd_result(True)
-        if (self.controller.user["username"] is not None):
-            if (self.left_foot == True and self.right_foot == True and self.esd_timer.is_timeout(1)):
 
-                if self.esd_testing:
-                    self.esd_testing = False
-                    # record passed result
-                    self.save_result(self.controller.user["username"], self.controller.user["fullname"], self.controller.test_type, self.esd_timer.duration(), "passed")
+    def on_unauthorized(self, username):
+        self.set_message('Unauthorized ' + str(username))
 
-                    self.set_message('Chúc bạn một ngày làm việc vui vẻ! ^_^')
-                    self.open_gate()
-                    self.refresh_timer.set_interval(3)
-                    self.after(3000, self.refresh)
-
-                return
+    def on_result(self, passed):
+        # displayed until the gate refreshes the screen
+        self.set_message('Chúc bạn một ngày làm việc vui vẻ! ^_^' if passed else 'Test thất bại! Mời bạn thử lại lần nữa!')
 
-        # wait for testing ESD
-        if (self.esd_timer.is_timeout()):
-            self.esd_testing = False
-            # record failed result
-            self.save_result(self.controller.user["username"], self.controller.user["fullname"], self.controller.test_type, self.esd_timer.duration(), "failed")
-
-            # display message within 3 seconds and refresh UI
-            self.set_message('Test thất bại! Mời bạn thử lại lần nữa!')
-            self.controller.mode = AppMode.IDLE
-            self.refresh_timer.set_interval(3)
-            self.after(3000, self.refresh)
-        else:
-            self.after(100, self.handle_esd_test)
-
-    def save_result(self, username, fullname, test_type, duration, result):
-        data = {
-            "username": username,
-            "fullname": fullname,
-            "type": test_type,
-            "duration": duration,
-            "result": result,
-            "machine": MACHINE
-        }
-
-        # log the result
-        info_log.info("{0}({1}) - mode:{2} - duration:{3} - result:{4} - machine:{5}".format(data["username"], data["fullname"], data["type"], data["duration"], data["result"], data["machine"]))
-        # save the result
-        try:
-            requests.post(API_URL + '/esd/save', data, timeout=REQUEST_TIMEOUT)
-        except:
-            # local storage when save data to server failed
-            self.save_file(data)
+    def on_refresh(self):
+        self.evidence.reset()
+        self.recent_crops.clear()
+        self.set_state_message()
 
-    def save_file(self, data):
-        f = open(DIR_NAME + '/records.txt', 'a')
-        f.write('{0},{1},{2},{3},{4},{5}\n'.format(data["username"], data["fullname"], data["type"], data["duration"], data["result"], data["machine"]))
-        f.close()
+    def on_restart(self, rss):
+        # the supervisor starts the station again, quit once the running tick is over as it destroys the window
+        self.controller.exit_code = 1
+        self.after_idle(self.controller.quit)
 
+    @span('video_stream')
     def video_stream(self):
-        # read camera frame and display on screen
-        _, frame = self.capture.read()
-        cv2image = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        # render image to screen
-        img = Image.fromarray(cv2image)
-        resized_img = img.resize((int(self.width * 0.99), int(self.height * 0.73)))
-        imgtk = ImageTk.PhotoImage(image=resized_img)
-        self.lmain.imgtk = imgtk
-        self.lmain.configure(image=imgtk)
-        self.lmain.update()
-
-        if self.req_queue.empty():
-            # put an function into queue, the function invokes handle method
-            self.req_queue.put(lambda: self.handle_image(frame))
-
-        # close camera if no any faces detected
-        if (self.face_timer.is_timeout()):
-            self.close_camera()
-        # recall to stream video
+        # runs CAMERA_FPS times per second while the camera is on
+        if (self.camera.failed):
+            self.camera_failed()
+            return
+
+        # display the latest camera frame, if there is a new one
+        seq, frame = self.frame_buffer.latest(hold=True)
+        try:
+            if frame is not None and seq != self.display_seq:
+                self.display_seq = seq
+                with RENDER_SECONDS.time():
+                    self.show_frame(frame)
+        finally:
+            self.frame_buffer.release(frame)
+
+    @span('show_frame')
+    def show_frame(self, frame):
+        width = int(self.width * 0.99)
+        height = int(self.height * 0.73)
+        # resize first so the color conversion runs on the smaller image, both into arrays reused for every frame
+        if self.display_rgb is None or self.display_rgb.shape[:2] != (height, width):
+            self.display_bgr = None
+            self.display_rgb = None
+        self.display_bgr = cv2.resize(frame, (width, height), dst=self.display_bgr, interpolation=cv2.INTER_AREA)
+        self.display_rgb = cv2.cvtColor(self.display_bgr, cv2.COLOR_BGR2RGB, dst=self.display_rgb)
+        # the image shares the array's memory, paste copies it into Tk
+        img = Image.frombuffer('RGB', (width, height), self.display_rgb, 'raw', 'RGB', 0, 1)
+        imgtk = self.lmain.imgtk
+        if imgtk is not None and imgtk.width() == width and imgtk.height() == height:
+            # update the existing image in place
+            imgtk.paste(img)
         else:
-            self.lmain.after(1, self.video_stream)
+            imgtk = ImageTk.PhotoImage(image=img)
+            self.lmain.imgtk = imgtk
+            self.lmain.configure(image=imgtk)
 
-    def observe_req_queue(self):
-        while True:
+    def observe_frames(self):
+        # fall back to full frames without a detector
+        try:
+            self.detector = FaceDetector(detect_width=FACE_DETECT_WIDTH, crop_size=FACE_CROP_SIZE)
+        except Exception as e:
+            error_log.exception(e, exc_info=True)
+        # local recognition learns from detected face crops only
+        if self.detector is not None and LOCAL_FACE_CAPACITY > 0:
             try:
-                if self.controller.mode == AppMode.QUIT:
-                    break
-                fn = self.req_queue.get()
-                fn()
-            except queue.Empty:
-                break
-
-        # observe the queue to handle until the application quit
-        if self.controller.mode != AppMode.QUIT:
-            self.lmain.after(100, self.observe_req_queue)
-
-    def post_image(self, base64img):
-        data = { "data": base64img }
-        r = requests.post(url = API_URL + "/face", data = data, timeout=REQUEST_TIMEOUT)
-        return r.json()
-
-    def set_result(self, result, id, name):
-        self.controller.result = result
-        self.controller.user["username"] = id
-        self.controller.user["fullname"] = name
-        self.set_state_message()
+                self.local_faces = LocalRecognizer(LOCAL_FACE_CAPACITY, LOCAL_FACE_SAMPLES, LOCAL_FACE_THRESHOLD)
+            except ImportError as e:
+                info_log.info('local face recognition disabled: {0}'.format(e))
+        seq = 0
+        # handle every new frame until the application quit, frames arriving meanwhile are skipped
+        while self.controller.mode != AppMode.QUIT:
+            seq, frame = self.frame_buffer.wait(seq, 0.5, hold=True)
+            if frame is not None:
+                try:
+                    self.handle_image(frame)
+                finally:
+                    self.frame_buffer.release(frame)
 
     def use_barcode(self, event=None):
-        self.recognizing = False
-        self.controller.mode = AppMode.BARCODE_SCAN
-        self.controller.test_type = "barcode"
+        self.machine.enter(AppMode.BARCODE_SCAN)
         self.set_state_message()
-        self.barcode_timer.reset()
-        self.handle_barcode()
 
-    def test_esd(self):
-        self.controller.mode = AppMode.ESD_TEST
-        self.set_state_message()
-        self.esd_timer.reset()
-        self.esd_testing = True
-        self.handle_esd_test()
+    def recognize_failed(self, value=None):
+        # change to barcode sanner if recognition failed
+        self.show_result('Mời bạn quét mã số')
 
+    @span('handle_image')
     def handle_image(self, imgframe):
+        # runs on the recognition thread, results go to the UI through the event queue
         if (self.controller.mode != AppMode.ESD_TEST):
             try:
-                self.frame_count += 1
-                if (len(self.req_list) == 0 or self.frame_count % 2 == 0):
-                    _, buf = cv2.imencode(".jpg", imgframe)
-                    base64img = base64.b64encode(buf)
-                    data = { "data": base64img }
-                    self.req_list.append(grequests.post(url = API_URL + "/face", data = data, timeout=REQUEST_TIMEOUT))
-                    self.frame_count = 0
-
-                # sent request to server every 0.5 seconds
-                if (self.dur_timer.is_timeout(0.1)):
-                    # send image to server in order to detect face id
-                    res = grequests.map(self.req_list, 10)
-                    self.req_list.clear()
-                    # sorted the response in ordered
-                    sorted_res = sorted(res, key=lambda x: 3 if x is None else 0 if x.json()["result"] else 1 if x.json()["username"] is not None else 2)
-                    if sorted_res[0] is not None:
-                        json = sorted_res[0].json()
+                if self.detector is not None:
+                    face = self.detector.detect(imgframe)
+                    if face is not None:
+                        # someone is in front of the camera, keep it on
+                        self.keep_camera_on()
+                        imgframe = self.detector.crop(imgframe, face, self.upload_rate.size())
                     else:
-                        json = { "result": False, "username": None }
-                    if (json["result"] == True and json["username"] != self.controller.user["username"]):
-                        self.controller.test_type = "face_id"
-                        self.set_result(True, json["username"], json["fullname"])
-                        if self.authenticate(self.controller.user["username"]):
-                            self.test_esd()
-
-                    # refresh face timer when there is a person detected
-                    if (json["username"] is not None):
-                        self.face_timer.reset()
-                        if (self.recognizing == False and json["username"] == ""):
-                            self.recognizing = True
-                            self.recog_timer.reset()
-                            self.controller.mode = AppMode.FACE_RECOGNIZE
-                            self.set_state_message()
-
-                    # timer reset every request posted
-                    self.dur_timer.reset()
-
-                # change to barcode sanner if recognition failed
-                if (self.recognizing == True and self.recog_timer.is_timeout()):
-                    self.use_barcode()
-                    self.set_message('Mời bạn quét mã số')
-                    self.refresh_timer.set_interval(3)
-                    self.after(3000, self.refresh)
+                        FRAMES_SKIPPED.inc()
+                        imgframe = None
+
+                if imgframe is not None and self.local_faces is not None:
+                    # a confident local match needs no server, authentication still verifies the employee
+                    match = self.local_faces.predict(imgframe)
+                    if match is not None:
+                        LOCAL_FACE_MATCHES.inc()
+                        self.events.put(("face", { "result": True, "username": match[0], "fullname": match[1], "local": True }))
+                        return
+
+                if imgframe is not None:
+                    # the first frame with a face is sent right away, the next ones at the rate the server copes with
+                    if self.upload_rate.allow():
+                        key = perceptual_hash(imgframe) if self.face_cache is not None else None
+                        cached = self.face_cache.get(key) if key is not None else None
+                        if cached is not None:
+                            # the same answer again is no new evidence
+                            self.events.put(("face", dict(cached, cached=True)))
+                        else:
+                            _, buf = cv2.imencode(".jpg", imgframe, [cv2.IMWRITE_JPEG_QUALITY, self.upload_rate.quality()])
+                            # the crop is a view of the camera's array, which is reused for later frames
+                            self.recognizer.submit(buf, key, imgframe.copy() if self.local_faces is not None else None)
+
+                # every response received since the last frame is evidence
+                for json, crops in self.recognizer.get_results():
+                    if self.local_faces is not None:
+                        if json["result"] == True:
+                            # only the crops this answer is about are labeled with its employee
+                            self.recent_crops.extend((json["username"], crop) for crop in crops)
+                        else:
+                            # someone else may be in front of the camera now
+                            self.recent_crops.clear()
+                    self.events.put(("face", json))
             except Exception as e:
-                print(e)
-                self.use_barcode()
-
-class Timer():
-
-    def __init__(self, interval=0):
-        self.timer = time.time()
-        self.interval = interval
-
-    def set_interval(self, interval):
-        self.interval = interval
-        self.reset()
-
-    def reset(self):
-        self.timer = time.time()
-
-    def duration(self):
-        return round(time.time() - self.timer, 2)
-
-    def is_timeout(self, seconds=None):
-        interval = seconds if seconds is not None else self.interval
-        return time.time() - self.timer > interval
+                error_log.exception(e, exc_info=True)
+                self.events.put(("face_error", None))
+
+    @span('handle_face')
+    def handle_face(self, json):
+        # refresh camera timeout when there is a person detected
+        if (json["username"] is not None):
+            self.keep_camera_on()
+
+        # a cached answer is for a near duplicate of a frame already answered, it counts for less
+        decision = self.evidence.add(json, FACE_CACHED_WEIGHT if json.get("cached") else 1.0)
+        if (decision == EvidenceAccumulator.UNKNOWN and self.controller.mode == AppMode.FACE_RECOGNIZE):
+            # consistently an unknown face, don't wait for the recognize timeout
+            self.evidence.reset()
+            self.recognize_failed()
+        elif (decision is not None and decision != EvidenceAccumulator.UNKNOWN and decision["username"] != self.gate.user["username"]):
+            json = decision
+            self.evidence.reset()
+            self.learn_face(json["username"], json["fullname"])
+            # the remaining frames of this person are of no use anymore
+            self.recognizer.cancel()
+            self.recent_crops.clear()
+            self.gate.start_test(json["username"], json["fullname"], "face_id")
+        elif (json["username"] == "" and self.controller.mode == AppMode.BARCODE_SCAN):
+            self.machine.enter(AppMode.FACE_RECOGNIZE)
+            self.set_state_message()
+
+    def learn_face(self, username, fullname):
+        # the crops of other answers, e.g. of an unknown visitor matched by mistake once, are never learned
+        crops = [crop for name, crop in list(self.recent_crops) if name == username]
+        self.recent_crops.clear()
+        if self.local_faces is not None and len(crops) > 0:
+            self.local_faces.add(username, fullname, crops)
+
+class ImageCache():
+
+    def __init__(self, capacity=16):
+        self.capacity = capacity
+        # source images by name, loaded from disk once
+        self.sources = {}
+        # resized photos by (name, size), least recently used first
+        self.photos = collections.OrderedDict()
+
+    def add(self, name, image):
+        self.sources[name] = image
+        self.invalidate(name)
+
+    def get(self, name, size):
+        key = (name, tuple(size))
+        photo = self.photos.get(key)
+        if photo is not None:
+            self.photos.move_to_end(key)
+            return photo
+
+        if name not in self.sources:
+            self.sources[name] = Image.open(name)
+        photo = ImageTk.PhotoImage(self.sources[name].resize(key[1]))
+        self.photos[key] = photo
+        while len(self.photos) > self.capacity:
+            self.photos.popitem(last=False)
+        return photo
+
+    def warm(self, names, size):
+        for name in names:
+            self.get(name, size)
+
+    def invalidate(self, name):
+        for key in [key for key in self.photos if key[0] == name]:
+            del self.photos[key]
 
 class ConfigPage(tk.Frame):
 
@@ -555,5 +650,7 @@ class ConfigPage(tk.Frame):
 
 
 if __name__ == "__main__":
+    profiler.install(DIR_NAME + '/logs', PROFILE_SECONDS)
     app = App()
     app.mainloop()
+    sys.exit(app.exit_code)
@@ -0,0 +1,97 @@
+# keeps an eye on the memory of a station that runs for days
+#
+# the resident size is exported as esd_rss_bytes, when it passes the limit or grows too far past its
+# size after warm-up the biggest allocation sites are logged and, with action "restart", the station
+# is told to exit so its supervisor (e.g. systemd) starts a fresh process
+
+import os
+import time
+import logging
+import threading
+import tracemalloc
+import metrics
+
+info_log = logging.getLogger('info')
+error_log = logging.getLogger('error')
+
+RSS_BYTES = metrics.gauge('esd_rss_bytes', 'Resident memory of the station process')
+MEMORY_ALERTS = metrics.counter('esd_memory_alerts_total', 'Times the memory watchdog found the process too big')
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+def rss():
+    '''Resident size of this process in bytes, None where /proc is missing'''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return None
+
+class MemoryWatchdog(threading.Thread):
+
+    def __init__(self, events, interval=60, warmup=600, limit=None, growth=None, action='log', trace_frames=0):
+        threading.Thread.__init__(self, name='memory-watchdog', daemon=True)
+        # ("memory", rss) is put here when the process should restart
+        self.events = events
+        self.interval = interval
+        self.warmup = warmup
+        # bytes, None for no check
+        self.limit = limit
+        self.growth = growth
+        self.action = action
+        # tracemalloc costs memory and time on every allocation, only on when asked for
+        self.trace_frames = trace_frames
+        self.baseline = None
+        self.snapshot = None
+        self.alerted = False
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        if self.trace_frames > 0:
+            tracemalloc.start(self.trace_frames)
+        started = time.monotonic()
+        while not self.stopped.wait(self.interval):
+            try:
+                self.check(time.monotonic() - started)
+            except Exception as e:
+                error_log.exception(e, exc_info=True)
+
+    def check(self, uptime):
+        size = rss()
+        if size is None:
+            return
+        RSS_BYTES.set(size)
+        if self.baseline is None and uptime >= self.warmup:
+            # camera, models and caches are all loaded by now
+            self.baseline = size
+            info_log.info('memory baseline {0} MB'.format(size // (1 << 20)))
+            if tracemalloc.is_tracing():
+                self.snapshot = tracemalloc.take_snapshot()
+
+        # the limit holds from the start, only the growth needs the baseline
+        reason = None
+        if self.limit is not None and size > self.limit:
+            reason = 'over the limit of {0} MB'.format(self.limit // (1 << 20))
+        elif self.growth is not None and self.baseline is not None and size - self.baseline > self.growth:
+            reason = 'grown {0} MB since warm-up'.format((size - self.baseline) // (1 << 20))
+        if reason is None:
+            self.alerted = False
+            return
+        if self.alerted:
+            # reported once per episode, not on every check
+            return
+        self.alerted = True
+        MEMORY_ALERTS.inc()
+        error_log.error('memory {0} MB, {1}{2}'.format(size // (1 << 20), reason, self.report()))
+        if self.action == 'restart':
+            self.events.put(("memory", size))
+
+    def report(self):
+        '''Allocation sites that grew the most since warm-up, when tracing'''
+        if self.snapshot is None:
+            return ''
+        stats = tracemalloc.take_snapshot().compare_to(self.snapshot, 'lineno')[:10]
+        return ''.join('\n  ' + str(stat) for stat in stats)
@@ -0,0 +1,225 @@
+# in-process counters and latency histograms, exposed in the Prometheus text format
+
+import os
+import time
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+error_log = logging.getLogger('error')
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def format_labels(labels):
+    if len(labels) == 0:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in labels) + '}'
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric():
+
+    def __init__(self, name, help, label_names=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.lock = threading.Lock()
+        self.children = {}
+
+    def labels(self, *values):
+        key = tuple(str(value) for value in values)
+        with self.lock:
+            child = self.children.get(key)
+            if child is None:
+                child = self.children[key] = self.new_child()
+            return child
+
+    def default(self):
+        # metric without labels
+        return self.labels()
+
+    def render(self):
+        lines = ['# HELP {0} {1}'.format(self.name, self.help), '# TYPE {0} {1}'.format(self.name, self.type)]
+        with self.lock:
+            children = sorted(self.children.items())
+        for key, child in children:
+            lines.extend(child.render(self.name, list(zip(self.label_names, key))))
+        return lines
+
+class CounterValue():
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def set(self, value):
+        with self.lock:
+            self.value = value
+
+    def render(self, name, labels):
+        return ['{0}{1} {2}'.format(name, format_labels(labels), format_value(self.value))]
+
+class Counter(Metric):
+
+    type = 'counter'
+
+    def new_child(self):
+        return CounterValue()
+
+    def inc(self, amount=1):
+        self.default().inc(amount)
+
+class Gauge(Metric):
+
+    type = 'gauge'
+
+    def new_child(self):
+        return CounterValue()
+
+    def set(self, value):
+        self.default().set(value)
+
+class HistogramValue():
+
+    def __init__(self, buckets):
+        self.lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        with self.lock:
+            self.count += 1
+            self.sum += value
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[index] += 1
+                    break
+
+    def time(self):
+        return HistogramTimer(self)
+
+    def render(self, name, labels):
+        with self.lock:
+            counts = list(self.counts)
+            count = self.count
+            total = self.sum
+        lines = []
+        cumulative = 0
+        for bound, bucket in zip(self.buckets, counts):
+            cumulative += bucket
+            lines.append('{0}_bucket{1} {2}'.format(name, format_labels(labels + [("le", format_value(float(bound)))]), cumulative))
+        lines.append('{0}_bucket{1} {2}'.format(name, format_labels(labels + [("le", "+Inf")]), count))
+        lines.append('{0}_sum{1} {2}'.format(name, format_labels(labels), repr(total)))
+        lines.append('{0}_count{1} {2}'.format(name, format_labels(labels), count))
+        return lines
+
+class HistogramTimer():
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started)
+        return False
+
+class Histogram(Metric):
+
+    type = 'histogram'
+
+    def __init__(self, name, help, label_names=(), buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, help, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def new_child(self):
+        return HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.default().observe(value)
+
+    def time(self):
+        return self.default().time()
+
+class Registry():
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def register(self, metric):
+        # metrics without labels are exported from the start, even before they are used
+        if len(metric.label_names) == 0:
+            metric.labels()
+        with self.lock:
+            # modules may be reloaded, keep the first instance
+            return self.metrics.setdefault(metric.name, metric)
+
+    def render(self):
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key=lambda metric: metric.name)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+def counter(name, help, label_names=()):
+    return REGISTRY.register(Counter(name, help, label_names))
+
+def gauge(name, help, label_names=()):
+    return REGISTRY.register(Gauge(name, help, label_names))
+
+def histogram(name, help, label_names=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, help, label_names, buckets))
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_server(port, host=''):
+    '''Serve /metrics on a background thread'''
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server
+
+def start_file_writer(file_name, interval):
+    '''Rewrite file_name with the current metrics every interval seconds'''
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                # replace atomically so a reader never sees a half written file
+                with open(file_name + '.tmp', 'w') as f:
+                    f.write(REGISTRY.render())
+                os.replace(file_name + '.tmp', file_name)
+            except Exception as e:
+                error_log.exception(e, exc_info=True)
+    thread = threading.Thread(target=run, name='metrics-file', daemon=True)
+    thread.start()
+    return thread
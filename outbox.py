@@ -0,0 +1,210 @@
+# durable local store for ESD results, replayed to the server by a background uploader
+
+import os
+import json
+import time
+import random
+import sqlite3
+import logging
+import threading
+import requests
+import metrics
+
+error_log = logging.getLogger('error')
+
+SAVE_SECONDS = metrics.histogram('esd_save_request_seconds', 'Round-trip time of /esd/save requests')
+SAVE_FAILURES = metrics.counter('esd_save_failures_total', 'Results that could not be delivered and will be retried')
+SAVE_REJECTED = metrics.counter('esd_save_rejected_total', 'Results the server refused with a 4xx status, kept and retried with the longest backoff')
+OUTBOX_PENDING = metrics.gauge('esd_outbox_pending', 'Results stored locally and not delivered yet')
+
+class Outbox():
+
+    def __init__(self, file_name, retention=7 * 24 * 3600):
+        dirname = os.path.dirname(file_name)
+        if len(dirname) > 0 and not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+        # delivered records are kept for this many seconds before purging
+        self.retention = retention
+        self.lock = threading.Lock()
+        # autocommit mode, every statement is its own transaction
+        self.conn = sqlite3.connect(file_name, isolation_level=None, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        # a commit is an append to the WAL without an fsync, it survives a crash of the station
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        # the WAL is synced and checkpointed by the uploader thread, the gate never waits for the SD card
+        self.conn.execute('PRAGMA wal_autocheckpoint=0')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS results (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created REAL NOT NULL,
+            data TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_try REAL NOT NULL DEFAULT 0,
+            delivered REAL
+        )''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS results_pending ON results (delivered, next_try)')
+
+    def put(self, data):
+        now = time.time()
+        with self.lock:
+            cur = self.conn.execute('INSERT INTO results (created, data) VALUES (?, ?)', (now, json.dumps(data)))
+            return cur.lastrowid
+
+    def pending(self, limit):
+        '''Return up to limit undelivered records that are due for (re)sending'''
+        with self.lock:
+            rows = self.conn.execute('SELECT id, data, attempts FROM results WHERE delivered IS NULL AND next_try <= ? ORDER BY id LIMIT ?', (time.time(), limit)).fetchall()
+        return [(id, json.loads(data), attempts) for id, data, attempts in rows]
+
+    def count_pending(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM results WHERE delivered IS NULL').fetchone()[0]
+
+    def next_due(self):
+        with self.lock:
+            row = self.conn.execute('SELECT MIN(next_try) FROM results WHERE delivered IS NULL').fetchone()
+        return row[0]
+
+    def mark_delivered(self, ids):
+        if len(ids) == 0:
+            return
+        now = time.time()
+        with self.lock:
+            self.conn.execute('BEGIN')
+            self.conn.executemany('UPDATE results SET delivered = ? WHERE id = ?', [(now, id) for id in ids])
+            self.conn.execute('COMMIT')
+
+    def mark_failed(self, records, backoff):
+        '''Bump the attempt counter and postpone each (id, attempts) record by backoff(attempts) seconds'''
+        if len(records) == 0:
+            return
+        now = time.time()
+        with self.lock:
+            self.conn.execute('BEGIN')
+            self.conn.executemany('UPDATE results SET attempts = attempts + 1, next_try = ? WHERE id = ?', [(now + backoff(attempts), id) for id, attempts in records])
+            self.conn.execute('COMMIT')
+
+    def checkpoint(self):
+        with self.lock:
+            self.conn.execute('PRAGMA wal_checkpoint(PASSIVE)')
+
+    def purge(self):
+        with self.lock:
+            self.conn.execute('DELETE FROM results WHERE delivered IS NOT NULL AND delivered < ?', (time.time() - self.retention,))
+
+    def import_legacy(self, file_name):
+        '''Move records from the old comma separated records file into the outbox'''
+        if not os.path.exists(file_name):
+            return 0
+
+        records = []
+        with open(file_name, 'r', encoding='utf-8', errors='replace') as f:
+            for line in f:
+                fields = line.rstrip('\n').split(',')
+                if len(fields) < 6:
+                    continue
+                # the full name may contain commas, every other field may not
+                records.append({
+                    "username": fields[0],
+                    "fullname": ','.join(fields[1:-4]),
+                    "type": fields[-4],
+                    "duration": fields[-3],
+                    "result": fields[-2],
+                    "machine": fields[-1]
+                })
+
+        now = time.time()
+        with self.lock:
+            self.conn.execute('BEGIN')
+            self.conn.executemany('INSERT INTO results (created, data) VALUES (?, ?)', [(now, json.dumps(data)) for data in records])
+            self.conn.execute('COMMIT')
+        os.replace(file_name, file_name + '.imported')
+        return len(records)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+class ResultUploader(threading.Thread):
+
+    def __init__(self, outbox, url, timeout, batch_size=20, min_backoff=2, max_backoff=600, idle_interval=30):
+        threading.Thread.__init__(self, name='result-uploader', daemon=True)
+        self.outbox = outbox
+        self.url = url
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        # how long to sleep when there is nothing due, unless notified
+        self.idle_interval = idle_interval
+        # keep-alive connection reused for every record of a batch, the server takes one record per request
+        self.session = requests.Session()
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+
+    def notify(self):
+        self.wake.set()
+
+    def stop(self):
+        self.stopped.set()
+        self.wake.set()
+
+    def backoff(self, attempts):
+        # exponential backoff with jitter so stations don't retry in lockstep after an outage
+        delay = min(self.max_backoff, self.min_backoff * 2 ** attempts)
+        return delay * random.uniform(0.5, 1.0)
+
+    def run(self):
+        self.outbox.purge()
+        while not self.stopped.is_set():
+            try:
+                batch = self.outbox.pending(self.batch_size)
+                if len(batch) > 0:
+                    self.send(batch)
+                    # keep draining while full batches are due
+                    if len(batch) == self.batch_size:
+                        continue
+                else:
+                    self.outbox.purge()
+                self.outbox.checkpoint()
+            except Exception as e:
+                error_log.exception(e, exc_info=True)
+
+            self.wait()
+
+    def wait(self):
+        timeout = self.idle_interval
+        next_due = self.outbox.next_due()
+        if next_due is not None:
+            timeout = min(timeout, max(0, next_due - time.time()))
+        self.wake.wait(timeout)
+        self.wake.clear()
+
+    def send(self, batch):
+        delivered = []
+        failed = []
+        rejected = []
+        for index, (id, data, attempts) in enumerate(batch):
+            try:
+                with SAVE_SECONDS.time():
+                    res = self.session.post(self.url, data, timeout=self.timeout)
+            except requests.RequestException:
+                # server is unreachable, postpone the rest of the batch as well
+                failed.extend((id, attempts) for id, _, attempts in batch[index:])
+                break
+
+            if res.status_code < 400:
+                delivered.append(id)
+            elif res.status_code < 500:
+                # a misrouted url or a server in maintenance refuses every record, keep them and try again much later
+                error_log.error('result rejected ({0}): {1}'.format(res.status_code, data))
+                rejected.append((id, attempts))
+            else:
+                failed.append((id, attempts))
+
+        self.outbox.mark_delivered(delivered)
+        self.outbox.mark_failed(failed, self.backoff)
+        self.outbox.mark_failed(rejected, lambda attempts: self.max_backoff)
+        SAVE_FAILURES.inc(len(failed))
+        SAVE_REJECTED.inc(len(rejected))
+        OUTBOX_PENDING.set(self.outbox.count_pending())
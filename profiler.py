@@ -0,0 +1,115 @@
+# on-demand sampling profiler and trace spans for a running station
+#
+#   kill -USR1 <pid>      sample every thread for PROFILE_SECONDS, written to logs/profile-<time>.folded
+#   kill -USR2 <pid>      toggle the trace spans, their timings go to esd_span_seconds
+#
+# the .folded files are collapsed stacks, e.g. for flamegraph.pl or speedscope
+
+import os
+import sys
+import time
+import signal
+import logging
+import threading
+import functools
+import collections
+import metrics
+
+info_log = logging.getLogger('info')
+error_log = logging.getLogger('error')
+
+SPAN_SECONDS = metrics.histogram('esd_span_seconds', 'Time spent in traced functions while tracing is on', ('span',))
+
+class SamplingProfiler():
+
+    def __init__(self, out_dir, interval=0.005):
+        self.out_dir = out_dir
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.running = False
+
+    def start(self, seconds):
+        '''Sample all threads for seconds on a background thread, unless a run is going on'''
+        with self.lock:
+            if self.running:
+                return False
+            self.running = True
+        threading.Thread(target=self.run, args=(seconds,), name='profiler', daemon=True).start()
+        return True
+
+    def run(self, seconds):
+        try:
+            stacks = self.sample(seconds)
+            file_name = self.write(stacks)
+            info_log.info('profile of {0} seconds written to {1}'.format(seconds, file_name))
+        except Exception as e:
+            error_log.exception(e, exc_info=True)
+        finally:
+            with self.lock:
+                self.running = False
+
+    def sample(self, seconds):
+        me = threading.get_ident()
+        stacks = collections.Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                calls = []
+                while frame is not None:
+                    code = frame.f_code
+                    calls.append('{0} ({1}:{2})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                    frame = frame.f_back
+                calls.append(names.get(ident, str(ident)))
+                stacks[';'.join(reversed(calls))] += 1
+            time.sleep(self.interval)
+        return stacks
+
+    def write(self, stacks):
+        if not os.path.exists(self.out_dir):
+            os.makedirs(self.out_dir)
+        file_name = os.path.join(self.out_dir, time.strftime('profile-%Y%m%d-%H%M%S.folded'))
+        with open(file_name, 'w') as f:
+            for stack, count in stacks.most_common():
+                f.write('{0} {1}\n'.format(stack, count))
+        return file_name
+
+class Tracer():
+
+    def __init__(self):
+        # checked on every call of a traced function, nothing else happens while it is off
+        self.enabled = False
+
+    def span(self, name):
+        '''Decorator timing the function as span name while tracing is on'''
+        def decorate(fn):
+            histogram = SPAN_SECONDS.labels(name)
+            @functools.wraps(fn)
+            def traced(*args, **kwargs):
+                if not self.enabled:
+                    return fn(*args, **kwargs)
+                started = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - started)
+            return traced
+        return decorate
+
+    def toggle(self):
+        self.enabled = not self.enabled
+        info_log.info('tracing ' + ('on' if self.enabled else 'off'))
+
+PROFILER = None
+TRACER = Tracer()
+span = TRACER.span
+
+def install(out_dir, seconds):
+    '''Profile on SIGUSR1 and toggle tracing on SIGUSR2, must be called from the main thread'''
+    global PROFILER
+    PROFILER = SamplingProfiler(out_dir)
+    # the handlers only start threads or flip a flag, the work is never done inside the signal handler
+    signal.signal(signal.SIGUSR1, lambda signum, frame: PROFILER.start(seconds))
+    signal.signal(signal.SIGUSR2, lambda signum, frame: TRACER.toggle())
@@ -0,0 +1,331 @@
+# client for the face recognition server
+
+import time
+import queue
+import base64
+import logging
+import threading
+import collections
+import concurrent.futures
+import requests
+from requests.adapters import HTTPAdapter
+import metrics
+
+error_log = logging.getLogger('error')
+
+FACE_SECONDS = metrics.histogram('esd_face_request_seconds', 'Round-trip time of /face requests')
+FACE_ERRORS = metrics.counter('esd_face_errors_total', 'Failed /face requests')
+FRAMES_UPLOADED = metrics.counter('esd_face_frames_uploaded_total', 'Face frames sent to the recognition server')
+FRAMES_DROPPED = metrics.counter('esd_face_frames_dropped_total', 'Face frames superseded or cancelled before being sent')
+FACE_CACHE_HITS = metrics.counter('esd_face_cache_hits_total', 'Face frames answered from the response cache instead of the server')
+FACE_UPLOAD_BYTES = metrics.counter('esd_face_upload_bytes_total', 'JPEG bytes of the face frames sent to the recognition server')
+
+# base64: the JPEG as a base64 form field, the format of older servers
+# jpeg: the raw JPEG as the request body
+# multipart: up to frames_per_request raw JPEGs as multipart parts of one request
+UPLOAD_FORMATS = ('base64', 'jpeg', 'multipart')
+
+UPLOAD_RATE = metrics.gauge('esd_face_upload_rate', 'Face frames per second the station may send, set by the rate controller')
+UPLOAD_QUALITY = metrics.gauge('esd_face_jpeg_quality', 'JPEG quality of uploaded face frames, set by the rate controller')
+UPLOAD_SIZE = metrics.gauge('esd_face_crop_size', 'Longest side of uploaded face frames in pixels, set by the rate controller')
+UPLOAD_TIMEOUT = metrics.gauge('esd_face_request_timeout_seconds', 'Timeout of /face requests, set by the rate controller')
+
+class RateController():
+    '''AIMD control of the face upload rate, quality and size from the latency and errors of /face'''
+
+    def __init__(self, min_rate=0.5, max_rate=7.5, step=0.5, target_latency=0.5, levels=((80, 200),), min_timeout=0.5, max_timeout=3):
+        self.lock = threading.Lock()
+        # frames per second, grows by step on every fast answer and halves on congestion
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.step = step
+        self.rate = max_rate
+        # answers slower than this count as congestion
+        self.target_latency = target_latency
+        # (JPEG quality, crop size) from the best to the cheapest, used once the rate is at its minimum
+        self.levels = levels
+        self.level = 0
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        # smoothed latency of the answers
+        self.latency = None
+        self.last_upload = None
+        self.last_decrease = 0
+        self.publish()
+
+    def allow(self):
+        '''Return True and count an upload if one is due at the current rate'''
+        now = time.monotonic()
+        with self.lock:
+            if self.last_upload is not None and now - self.last_upload < 1.0 / self.rate:
+                return False
+            self.last_upload = now
+            return True
+
+    def quality(self):
+        return self.levels[self.level][0]
+
+    def size(self):
+        return self.levels[self.level][1]
+
+    def timeout(self):
+        # a few times the usual latency, a request taking longer is lost anyway
+        latency = self.latency
+        if latency is None:
+            return self.max_timeout
+        return max(self.min_timeout, min(self.max_timeout, 4 * latency))
+
+    def observe(self, latency, ok):
+        '''Take the outcome of a request, latency is None if it failed or timed out'''
+        now = time.monotonic()
+        with self.lock:
+            if latency is not None:
+                self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+            if ok and latency is not None and latency <= self.target_latency:
+                # additive increase, the cheaper levels are left first
+                if self.level > 0:
+                    self.level -= 1
+                else:
+                    self.rate = min(self.max_rate, self.rate + self.step)
+            elif now - self.last_decrease >= (self.latency or self.target_latency):
+                # multiplicative decrease, at most once per round trip as the answers in flight tell the same
+                self.last_decrease = now
+                if self.rate > self.min_rate:
+                    self.rate = max(self.min_rate, self.rate / 2)
+                elif self.level < len(self.levels) - 1:
+                    self.level += 1
+        self.publish()
+
+    def publish(self):
+        UPLOAD_RATE.set(self.rate)
+        UPLOAD_QUALITY.set(self.quality())
+        UPLOAD_SIZE.set(self.size())
+        UPLOAD_TIMEOUT.set(self.timeout())
+
+class EvidenceAccumulator():
+    '''Fuses /face answers over successive frames into a decision, older answers weigh less'''
+
+    UNKNOWN = ""
+
+    def __init__(self, match_threshold=1.0, unknown_threshold=3.0, half_life=1.5, window=2.5, unknown_share=0.8):
+        # evidence needed to commit to an employee
+        self.match_threshold = match_threshold
+        self.half_life = half_life
+        # unknown answers needed within the window, and their share of all answers in it, to give up on a face
+        self.unknown_threshold = unknown_threshold
+        self.window = window
+        self.unknown_share = unknown_share
+        # username -> [evidence, time it was last decayed, latest answer]
+        self.scores = {}
+        # (time, username or UNKNOWN, weight) of the answers within the window
+        self.recent = collections.deque()
+
+    def add(self, answer, weight=1.0, now=None):
+        '''Add an answer, return the answer of the employee committed to, UNKNOWN to give up or None to wait'''
+        if now is None:
+            now = time.monotonic()
+        if answer["result"] == True:
+            name = answer["username"]
+            weight *= answer.get("confidence", 1.0)
+        elif answer["username"] == "":
+            name = self.UNKNOWN
+        else:
+            # no face in the frame, no evidence either way
+            return None
+
+        self.decay(now)
+        self.recent.append((now, name, weight))
+        while now - self.recent[0][0] > self.window:
+            self.recent.popleft()
+
+        if name == self.UNKNOWN:
+            # a plain count over the window, a decayed sum levels off below the threshold at low answer rates
+            total = sum(weight for _, _, weight in self.recent)
+            unknown = sum(weight for _, other, weight in self.recent if other == self.UNKNOWN)
+            # only give up when hardly any employee has been seen meanwhile
+            if unknown >= self.unknown_threshold and unknown >= self.unknown_share * total:
+                return self.UNKNOWN
+            return None
+
+        score = self.scores.setdefault(name, [0.0, now, answer])
+        score[0] += weight
+        score[2] = answer
+        # an employee has to stand out from the other employees, unknown answers only mean a poor frame
+        ranked = sorted((evidence for other, (evidence, _, _) in self.scores.items() if other != name), reverse=True)
+        runner_up = ranked[0] if len(ranked) > 0 else 0.0
+        if score[0] >= self.match_threshold and score[0] >= 2 * runner_up:
+            return answer
+        return None
+
+    def decay(self, now):
+        for name in list(self.scores):
+            score = self.scores[name]
+            score[0] *= 0.5 ** ((now - score[1]) / self.half_life)
+            score[1] = now
+            if score[0] < 0.01:
+                del self.scores[name]
+
+    def reset(self):
+        self.scores = {}
+        self.recent.clear()
+
+class ResponseCache():
+    '''Recent /face answers by perceptual hash of the frame, a near duplicate frame gets the same answer'''
+
+    def __init__(self, ttl=2.0, capacity=32, max_distance=6):
+        self.ttl = ttl
+        self.capacity = capacity
+        # hashes differing in at most this many bits are near duplicates
+        self.max_distance = max_distance
+        self.lock = threading.Lock()
+        # hash -> (time, answer), oldest first
+        self.entries = collections.OrderedDict()
+
+    def get(self, key):
+        '''Return the answer for the closest cached frame to key, or None'''
+        now = time.monotonic()
+        with self.lock:
+            while len(self.entries) > 0:
+                oldest = next(iter(self.entries))
+                if now - self.entries[oldest][0] <= self.ttl:
+                    break
+                del self.entries[oldest]
+
+            best = None
+            for cached, (_, answer) in self.entries.items():
+                distance = bin(cached ^ key).count('1')
+                if distance <= self.max_distance and (best is None or distance < best[0]):
+                    best = (distance, answer)
+        if best is None:
+            return None
+        FACE_CACHE_HITS.inc()
+        return best[1]
+
+    def put(self, key, answer):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.monotonic(), answer)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+class RecognitionClient():
+
+    def __init__(self, url, rate, max_inflight=2, upload_format='base64', frames_per_request=1, cache=None):
+        if upload_format not in UPLOAD_FORMATS:
+            raise ValueError('unknown upload format: ' + str(upload_format))
+        self.url = url
+        # decides how often, how large and with which timeout frames are sent
+        self.rate = rate
+        # answers are stored by the key the frame was submitted with
+        self.cache = cache
+        self.max_inflight = max_inflight
+        self.upload_format = upload_format
+        # only multipart requests carry more than one frame
+        self.frames_per_request = frames_per_request if upload_format == 'multipart' else 1
+        # keep-alive connections, one per request in flight
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_inflight)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_inflight, thread_name_prefix='face')
+        self.lock = threading.Lock()
+        self.inflight = 0
+        # the latest (frame, key, sample) waiting for a free slot, newer ones replace the oldest
+        self.waiting = []
+        # bumped by cancel, responses of older generations are ignored
+        self.generation = 0
+        self.dropped = 0
+        self.results = queue.Queue()
+
+    def submit(self, jpeg, key=None, sample=None):
+        '''Send the JPEG buffer of cv2.imencode to the server or keep it until a request slot is free, sample comes back with its answer'''
+        # a flat byte view of the encoder's buffer, the frame is never copied before it is sent
+        frame = memoryview(jpeg).cast('B')
+        with self.lock:
+            if self.inflight < self.max_inflight:
+                self.inflight += 1
+                self.executor.submit(self.post, [(frame, key, sample)], self.generation)
+            else:
+                self.waiting.append((frame, key, sample))
+                if len(self.waiting) > self.frames_per_request:
+                    self.waiting.pop(0)
+                    self.dropped += 1
+                    FRAMES_DROPPED.inc()
+
+    def cancel(self):
+        '''Drop the waiting frame and ignore the responses still in flight'''
+        with self.lock:
+            self.generation += 1
+            self.dropped += len(self.waiting)
+            FRAMES_DROPPED.inc(len(self.waiting))
+            self.waiting = []
+        if self.cache is not None:
+            self.cache.clear()
+        # results that arrived before the cancel are stale as well
+        while True:
+            try:
+                self.results.get_nowait()
+            except queue.Empty:
+                break
+
+    def get_results(self):
+        '''Return (answer, samples of the frames it answers) for the responses received since the last call'''
+        results = []
+        while True:
+            try:
+                results.append(self.results.get_nowait())
+            except queue.Empty:
+                return results
+
+    def request_args(self, frames):
+        if self.upload_format == 'base64':
+            return { "data": { "data": base64.b64encode(frames[-1]) } }
+        elif self.upload_format == 'jpeg':
+            return { "data": frames[-1], "headers": { "Content-Type": "image/jpeg" } }
+        return { "files": [("frames", ("frame{0}.jpg".format(index), frame, "image/jpeg")) for index, frame in enumerate(frames)] }
+
+    def post(self, items, generation):
+        while len(items) > 0:
+            frames = [frame for frame, _, _ in items]
+            FRAMES_UPLOADED.inc(len(frames))
+            FACE_UPLOAD_BYTES.inc(sum(frame.nbytes for frame in frames))
+            started = time.perf_counter()
+            try:
+                # every response is parsed exactly once, here
+                res = self.session.post(self.url, timeout=self.rate.timeout(), **self.request_args(frames))
+                latency = time.perf_counter() - started
+                FACE_SECONDS.observe(latency)
+                res.raise_for_status()
+                result = res.json()
+                # anything else is no answer about the face, e.g. the error body of a proxy
+                if not isinstance(result, dict) or "result" not in result or "username" not in result:
+                    raise ValueError('unexpected answer: {0}'.format(result))
+                self.rate.observe(latency, True)
+            except Exception as e:
+                result = None
+                FACE_ERRORS.inc()
+                self.rate.observe(None, False)
+                error_log.error('face request failed: {0}'.format(e))
+
+            with self.lock:
+                if result is not None and generation == self.generation:
+                    self.results.put((result, [sample for _, _, sample in items if sample is not None]))
+                    if self.cache is not None:
+                        for _, key, _ in items:
+                            if key is not None:
+                                self.cache.put(key, result)
+                # reuse this slot for the frames that were waiting, if any
+                items = self.waiting
+                self.waiting = []
+                generation = self.generation
+                if len(items) == 0:
+                    self.inflight -= 1
+
+    def close(self):
+        self.cancel()
+        self.executor.shutdown(wait=False)
+        self.session.close()
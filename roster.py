@@ -0,0 +1,124 @@
+# local copy of the authorized employee roster, kept current by delta syncs from the server
+
+import os
+import time
+import sqlite3
+import logging
+import threading
+import requests
+import metrics
+
+error_log = logging.getLogger('error')
+
+ROSTER_SIZE = metrics.gauge('esd_roster_employees', 'Employees in the local roster')
+ROSTER_SYNC_SECONDS = metrics.histogram('esd_roster_sync_seconds', 'Round-trip time of roster syncs')
+ROSTER_SYNC_FAILURES = metrics.counter('esd_roster_sync_failures_total', 'Roster syncs that failed')
+ROSTER_SYNCED = metrics.gauge('esd_roster_synced_timestamp_seconds', 'Unix time of the last successful roster sync')
+ROSTER_LOOKUPS = metrics.counter('esd_roster_lookups_total', 'Username lookups in the local roster by result', ('result',))
+
+FIELDS = ("username", "fullname", "gender", "date_of_birth")
+
+class Roster():
+
+    def __init__(self, file_name, max_age=None):
+        dirname = os.path.dirname(file_name)
+        if len(dirname) > 0 and not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(file_name, isolation_level=None, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS employees (
+            username TEXT PRIMARY KEY,
+            fullname TEXT,
+            gender TEXT,
+            date_of_birth TEXT
+        )''')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+
+        # the whole roster is held in memory, lookups never touch the disk
+        self.employees = dict((row[0], dict(zip(FIELDS, row))) for row in self.conn.execute('SELECT username, fullname, gender, date_of_birth FROM employees'))
+        meta = dict(self.conn.execute('SELECT key, value FROM meta'))
+        # version of the server's roster this copy is current with, None until the first sync
+        self.version = meta.get('version')
+        # when a sync last succeeded, kept across restarts so an outage isn't forgotten
+        self.synced = float(meta['synced']) if 'synced' in meta else None
+        # seconds without a successful sync before the copy isn't trusted anymore, None for no limit
+        self.max_age = max_age
+        ROSTER_SIZE.set(len(self.employees))
+        if self.synced is not None:
+            ROSTER_SYNCED.set(self.synced)
+
+    def ready(self):
+        '''True while the roster may answer lookups, employees removed on the server since would pass otherwise'''
+        if self.version is None:
+            return False
+        return self.max_age is None or (self.synced is not None and time.time() - self.synced <= self.max_age)
+
+    def get(self, username):
+        '''Return the employee record of username or None if it is not in the roster'''
+        employee = self.employees.get(username)
+        ROSTER_LOOKUPS.labels('hit' if employee is not None else 'miss').inc()
+        return employee
+
+    def apply(self, version, employees, deleted, full=False):
+        '''Store a sync from the server, a full sync replaces the whole roster'''
+        records = [dict((field, employee.get(field)) for field in FIELDS) for employee in employees]
+        with self.lock:
+            self.conn.execute('BEGIN')
+            if full:
+                self.conn.execute('DELETE FROM employees')
+            self.conn.executemany('INSERT OR REPLACE INTO employees (username, fullname, gender, date_of_birth) VALUES (?, ?, ?, ?)', [tuple(record[field] for field in FIELDS) for record in records])
+            self.conn.executemany('DELETE FROM employees WHERE username = ?', [(username,) for username in deleted])
+            synced = time.time()
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('version', ?)", (str(version),))
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('synced', ?)", (str(synced),))
+            self.conn.execute('COMMIT')
+
+            # swap in a new index so lookups on other threads never see a half applied sync
+            index = {} if full else dict(self.employees)
+            for record in records:
+                index[record["username"]] = record
+            for username in deleted:
+                index.pop(username, None)
+            self.employees = index
+            self.version = str(version)
+            self.synced = synced
+        ROSTER_SIZE.set(len(index))
+        ROSTER_SYNCED.set(synced)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+class RosterSync(threading.Thread):
+
+    def __init__(self, roster, url, timeout, interval):
+        threading.Thread.__init__(self, name='roster-sync', daemon=True)
+        self.roster = roster
+        self.url = url
+        self.timeout = timeout
+        self.interval = interval
+        self.session = requests.Session()
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.sync()
+            except Exception as e:
+                ROSTER_SYNC_FAILURES.inc()
+                error_log.error('roster sync failed: {0}'.format(e))
+            self.stopped.wait(self.interval)
+
+    def sync(self):
+        # the first sync downloads the whole roster, later ones only what changed since our version
+        params = {} if self.roster.version is None else { "since": self.roster.version }
+        with ROSTER_SYNC_SECONDS.time():
+            res = self.session.get(self.url, params=params, timeout=self.timeout)
+        res.raise_for_status()
+        json = res.json()
+        self.roster.apply(json["version"], json.get("employees", []), json.get("deleted", []), json.get("full", self.roster.version is None))
@@ -0,0 +1,134 @@
+# barcode scanners read straight from their input devices, whatever window has the focus
+
+import time
+import logging
+import threading
+
+error_log = logging.getLogger('error')
+info_log = logging.getLogger('info')
+
+# evdev key name -> (char, char with shift)
+KEY_CHARS = dict(
+    [('KEY_{0}'.format(digit), (str(digit), ')!@#$%^&*('[digit])) for digit in range(10)] +
+    [('KEY_KP{0}'.format(digit), (str(digit), str(digit))) for digit in range(10)] +
+    [('KEY_' + letter, (letter.lower(), letter)) for letter in 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'] +
+    [('KEY_MINUS', ('-', '_')), ('KEY_EQUAL', ('=', '+')), ('KEY_DOT', ('.', '>')), ('KEY_COMMA', (',', '<')),
+     ('KEY_SLASH', ('/', '?')), ('KEY_SEMICOLON', (';', ':')), ('KEY_APOSTROPHE', ("'", '"')), ('KEY_SPACE', (' ', ' ')),
+     ('KEY_LEFTBRACE', ('[', '{')), ('KEY_RIGHTBRACE', (']', '}')), ('KEY_BACKSLASH', ('\\', '|')), ('KEY_GRAVE', ('`', '~')),
+     ('KEY_KPMINUS', ('-', '-')), ('KEY_KPDOT', ('.', '.'))]
+)
+ENTER_KEYS = ('KEY_ENTER', 'KEY_KPENTER')
+SHIFT_KEYS = ('KEY_LEFTSHIFT', 'KEY_RIGHTSHIFT')
+
+class BurstDecoder():
+    '''Tells scanner bursts from typing by the time between keys'''
+
+    def __init__(self, max_gap=0.05, min_length=4):
+        # a scanner sends its keys within a few milliseconds of each other, people don't
+        self.max_gap = max_gap
+        self.min_length = min_length
+        self.chars = []
+        self.last = None
+
+    def key(self, char, t):
+        if self.last is not None and t - self.last > self.max_gap:
+            # too slow for a scanner, start over
+            self.chars = []
+        self.chars.append(char)
+        self.last = t
+
+    def enter(self, t):
+        '''Return the code ended by Enter at time t, or None if it wasn't a scanner burst'''
+        code = None
+        if self.last is not None and t - self.last <= self.max_gap and len(self.chars) >= self.min_length:
+            code = ''.join(self.chars)
+        self.chars = []
+        self.last = None
+        return code
+
+class EvdevScanner(threading.Thread):
+
+    def __init__(self, device, events, max_gap=0.05, min_length=4, retry_interval=5):
+        threading.Thread.__init__(self, name='scanner ' + device, daemon=True)
+        # device path or (part of) the device name
+        self.device = device
+        # ("barcode", (code, monotonic time of the Enter key)) is put here for every scan
+        self.events = events
+        self.decoder = BurstDecoder(max_gap, min_length)
+        self.retry_interval = retry_interval
+        self.stopped = threading.Event()
+
+    def open(self):
+        import evdev
+        path = self.device
+        if not path.startswith('/dev/'):
+            paths = [name for name in evdev.list_devices() if self.device in evdev.InputDevice(name).name]
+            if len(paths) == 0:
+                raise IOError('no input device named ' + self.device)
+            path = paths[0]
+        device = evdev.InputDevice(path)
+        # the scanner's keys go to us only, not to the focused window or the console
+        device.grab()
+        return evdev, device
+
+    def run(self):
+        logged = False
+        while not self.stopped.is_set():
+            try:
+                evdev, device = self.open()
+            except Exception as e:
+                # log once, not on every retry
+                if not logged:
+                    error_log.error('cannot open scanner {0}: {1}'.format(self.device, e))
+                    logged = True
+                self.stopped.wait(self.retry_interval)
+                continue
+
+            logged = False
+            info_log.info('scanner {0} opened: {1}'.format(self.device, device.name))
+            try:
+                self.read(evdev, device)
+            except OSError as e:
+                # unplugged, wait for it to come back
+                error_log.error('scanner {0} lost: {1}'.format(self.device, e))
+            finally:
+                try:
+                    device.close()
+                except Exception:
+                    pass
+
+    def read(self, evdev, device):
+        keys = evdev.ecodes.KEY
+        shift = False
+        for event in device.read_loop():
+            if self.stopped.is_set():
+                return
+            if event.type != evdev.ecodes.EV_KEY:
+                continue
+            name = keys.get(event.code)
+            # some codes have several names
+            if isinstance(name, list):
+                name = name[0]
+            if name in SHIFT_KEYS:
+                shift = event.value != 0
+            elif event.value != 1:
+                # key up and auto repeat
+                continue
+            elif name in ENTER_KEYS:
+                code = self.decoder.enter(event.timestamp())
+                if code is not None:
+                    self.events.put(("barcode", (code, time.monotonic())))
+            elif name in KEY_CHARS:
+                self.decoder.key(KEY_CHARS[name][1 if shift else 0], event.timestamp())
+
+    def stop(self):
+        self.stopped.set()
+
+def start_scanners(devices, events, max_gap, min_length):
+    '''Read each of the scanner devices on its own thread'''
+    scanners = []
+    for device in devices:
+        scanner = EvdevScanner(device, events, max_gap, min_length)
+        scanner.start()
+        scanners.append(scanner)
+    return scanners
@@ -0,0 +1,136 @@
+# single-tick scheduler with named tasks and a mode transition table on top of it
+
+import heapq
+import logging
+import threading
+import time
+
+error_log = logging.getLogger('error')
+
+class Scheduler():
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.lock = threading.Lock()
+        # name -> [deadline, interval, fn, args, seq], a task name exists at most once
+        self.tasks = {}
+        # (deadline, seq, name), entries of replaced or cancelled tasks are skipped when popped
+        self.heap = []
+        self.seq = 0
+
+    def call_later(self, name, delay, fn, *args):
+        '''Run fn once after delay seconds, replacing any task with the same name'''
+        self.add(name, delay, None, fn, args)
+
+    def call_every(self, name, interval, fn, *args):
+        '''Run fn every interval seconds, replacing any task with the same name'''
+        self.add(name, interval, interval, fn, args)
+
+    def add(self, name, delay, interval, fn, args):
+        with self.lock:
+            self.seq += 1
+            deadline = self.clock() + delay
+            self.tasks[name] = [deadline, interval, fn, args, self.seq]
+            heapq.heappush(self.heap, (deadline, self.seq, name))
+
+    def cancel(self, name):
+        with self.lock:
+            self.tasks.pop(name, None)
+
+    def pending(self, name):
+        with self.lock:
+            return name in self.tasks
+
+    def remaining(self, name):
+        '''Seconds until the task runs, or None if there is no such task'''
+        with self.lock:
+            task = self.tasks.get(name)
+            return None if task is None else max(0, task[0] - self.clock())
+
+    def run_pending(self):
+        '''Run every due task and return the seconds until the next one, or None'''
+        while True:
+            with self.lock:
+                task = self.pop_due()
+                if task is None:
+                    return self.next_delay()
+                name, fn, args = task
+            try:
+                fn(*args)
+            except Exception as e:
+                error_log.exception(e, exc_info=True)
+
+    def pop_due(self):
+        now = self.clock()
+        while len(self.heap) > 0:
+            deadline, seq, name = self.heap[0]
+            task = self.tasks.get(name)
+            if task is None or task[4] != seq:
+                # stale entry of a replaced or cancelled task
+                heapq.heappop(self.heap)
+                continue
+            if deadline > now:
+                return None
+
+            heapq.heappop(self.heap)
+            interval, fn, args = task[1], task[2], task[3]
+            if interval is None:
+                del self.tasks[name]
+            else:
+                # fixed rate, but don't try to catch up with missed runs
+                self.seq += 1
+                task[0] = max(deadline + interval, now)
+                task[4] = self.seq
+                heapq.heappush(self.heap, (task[0], self.seq, name))
+            return name, fn, args
+        return None
+
+    def next_delay(self):
+        while len(self.heap) > 0:
+            deadline, seq, name = self.heap[0]
+            task = self.tasks.get(name)
+            if task is None or task[4] != seq:
+                heapq.heappop(self.heap)
+                continue
+            return max(0, deadline - self.clock())
+        return None
+
+class StateMachine():
+
+    def __init__(self, scheduler, mode, on_enter=None):
+        self.scheduler = scheduler
+        self.mode = mode
+        self.on_enter = on_enter
+        # (mode, event) -> handler, a mode of None matches any mode
+        self.transitions = {}
+        # mode -> [(seconds, event)] scheduled on entering the mode and cancelled on leaving it
+        self.timeouts = {}
+
+    def on(self, modes, events, handler):
+        '''Let handler take events (a name or a tuple of names) in modes (a mode, a tuple of modes or None for any)'''
+        for mode in (modes if isinstance(modes, (list, tuple)) else (modes,)):
+            for event in (events if isinstance(events, (list, tuple)) else (events,)):
+                self.transitions[(mode, event)] = handler
+
+    def timeout(self, mode, seconds, event):
+        self.timeouts.setdefault(mode, []).append((seconds, event))
+
+    def enter(self, mode, **seconds):
+        '''Switch to mode and arm its timeouts, seconds overrides the duration of a timeout by event name'''
+        for _, event in self.timeouts.get(self.mode, ()):
+            self.scheduler.cancel('timeout:' + event)
+        self.mode = mode
+        for default, event in self.timeouts.get(mode, ()):
+            self.scheduler.call_later('timeout:' + event, seconds.get(event, default), self.dispatch, event)
+        if self.on_enter is not None:
+            self.on_enter(mode)
+
+    def dispatch(self, event, *args):
+        '''Run the handler of event for the current mode, return False if the mode ignores it'''
+        handler = self.transitions.get((self.mode, event))
+        if handler is None:
+            handler = self.transitions.get((None, event))
+        if handler is None:
+            return False
+        handler(*args)
+        return True
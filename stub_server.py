@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+# local stand-in for the ESD and face recognition server, used for simulation and benchmarks
+
+import json
+import time
+import random
+import argparse
+import threading
+import collections
+from urllib.parse import parse_qs, urlparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class StubServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.05, jitter=0.0, error_rate=0.0, face_after=3, unauthorized=(), roster=100):
+        ThreadingHTTPServer.__init__(self, address, StubHandler)
+        # seconds added to every response, plus up to jitter seconds at random
+        self.latency = latency
+        self.jitter = jitter
+        # share of requests answered with a 500
+        self.error_rate = error_rate
+        # number of unknown-face answers before a face is recognized
+        self.face_after = face_after
+        self.unauthorized = set(unauthorized)
+        # EMP0001 .. EMP<roster> are on the roster, which never changes
+        self.roster = [{ "username": "EMP{0:04d}".format(n), "fullname": "Employee EMP{0:04d}".format(n), "gender": None, "date_of_birth": None } for n in range(1, roster + 1)]
+        self.lock = threading.Lock()
+        self.faces_seen = 0
+        self.requests = collections.Counter()
+        self.errors = collections.Counter()
+        self.bytes_received = collections.Counter()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "requests": dict(self.requests),
+                "errors": dict(self.errors),
+                "bytes_received": dict(self.bytes_received)
+            }
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    # keep-alive, like the real server
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path.endswith('/stats'):
+            self.send_json(200, self.server.stats())
+        elif url.path.endswith('/esd/roster'):
+            with self.server.lock:
+                self.server.requests[url.path] += 1
+            if 'since' in parse_qs(url.query):
+                self.send_json(200, { "version": "1", "employees": [], "deleted": [] })
+            else:
+                self.send_json(200, { "version": "1", "full": True, "employees": [employee for employee in self.server.roster if employee["username"] not in self.server.unauthorized], "deleted": [] })
+        else:
+            self.send_json(404, {})
+
+    def do_POST(self):
+        server = self.server
+        path = urlparse(self.path).path
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with server.lock:
+            server.requests[path] += 1
+            server.bytes_received[path] += len(body)
+
+        time.sleep(server.latency + random.uniform(0, server.jitter))
+        if random.random() < server.error_rate:
+            with server.lock:
+                server.errors[path] += 1
+            self.send_json(500, {})
+            return
+
+        form = dict((key, values[0]) for key, values in parse_qs(body.decode('latin-1')).items()) if self.headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded') else {}
+        if path.endswith('/esd/authenticate'):
+            username = form.get("username")
+            if username in server.unauthorized:
+                self.send_json(401, {})
+            else:
+                self.send_json(200, { "username": username, "fullname": "Employee " + str(username), "gender": None, "date_of_birth": None })
+        elif path.endswith('/esd/save'):
+            self.send_json(200, {})
+        elif path.endswith('/face'):
+            with server.lock:
+                server.faces_seen += 1
+                recognized = server.faces_seen > server.face_after
+                if recognized:
+                    server.faces_seen = 0
+            if recognized:
+                self.send_json(200, { "result": True, "username": "stub", "fullname": "Stub Employee" })
+            else:
+                self.send_json(200, { "result": False, "username": "" })
+        else:
+            self.send_json(404, {})
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def main():
+    parser = argparse.ArgumentParser(description='Stub ESD/face recognition server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8989)
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random extra latency, seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests failing with 500')
+    parser.add_argument('--face-after', type=int, default=3, help='unknown-face answers before a match')
+    parser.add_argument('--unauthorized', nargs='*', default=[], help='usernames answered with 401')
+    parser.add_argument('--roster', type=int, default=100, help='employees on the roster, EMP0001 and up')
+    args = parser.parse_args()
+
+    server = StubServer((args.host, args.port), args.latency, args.jitter, args.error_rate, args.face_after, args.unauthorized, args.roster)
+    print('stub server on http://{0}:{1}/api'.format(args.host, server.server_address[1]), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()